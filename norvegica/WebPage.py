@@ -1,25 +1,26 @@
-import difflib
+import codecs
 import re
-import socket
 import time
 from collections import OrderedDict
 from datetime import datetime
+from email.utils import formatdate
 from functools import cached_property
+from itertools import groupby
 from http import HTTPStatus
-from http import HTTPStatus
-from http.client import IncompleteRead
-from ssl import CertificateError
-from typing import Tuple, Optional
-from urllib.error import HTTPError, URLError
+from typing import Iterable, Tuple, Optional, Union
 from urllib.parse import urlunparse, urlencode, urlparse
 from urllib.request import Request, urlopen
 
-import bs4
+import aiohttp
 from dateutil import parser
 from dateutil.parser import ParserError
 from dateutil.tz import UTC
 
+import config
+import metrics
+import patterns
 import souper
+import textdiff
 
 
 class WebPage:
@@ -27,22 +28,40 @@ class WebPage:
     Simple class to handle logic for web pages.
     """
 
-    def __init__(self, orig_url: str, redirect_url: str, raw_html: str, ip: str, timestamp: Optional[int] = None,
-                 geo_loc: Optional[str] = None, content_language: Optional[str] = None,
-                 last_modified: Optional[int] = None, etag: Optional[str] = None, no_version: Optional[str] = None):
+    # The stages of cascade, from the cheapest, after the headers which are always used
+    CASCADE_STAGES = ("parse", "postal", "language", "regex")
+
+    # The fields of extra_info, in order
+    FIELDS = ("original_url", "redirect_url", "timestamp", "ip", "geo", "domain", "content_language", "last_modified",
+              "etag", "truncated", "html_lang", "language", "norwegian_version", "regex", "norvegica_score", "links",
+              "text")
+
+    def __init__(self, orig_url: str, redirect_url: str, raw_html: Union[str, bytes, memoryview], ip: str,
+                 timestamp: Optional[int] = None, geo_loc: Optional[str] = None, content_language: Optional[str] = None,
+                 last_modified: Optional[int] = None, etag: Optional[str] = None, no_version: Optional[str] = None,
+                 truncated: bool = False, charset: Optional[str] = None):
         """
         :param orig_url: the original URL.
         :param redirect_url: the new URL after being redirected.
-        :param raw_html: the HTML of the web page.
+        :param raw_html: the HTML of the web page, or its undecoded payload which is only decoded when needed.
         :param geo_loc: the geolocation of the site.
         :param ip: the ip of the page.
         :param content_language: the value of the content-language header received.
         :param no_version: Norwegian version of the site if applicable.
         :param timestamp: When the site was harvested. Preferably UTC time for consistency.
+        :param truncated: whether the HTML was cut off at the maximum download size.
+        :param charset: the charset of an undecoded payload, sniffed from it if None.
         """
         self.original_url = orig_url
         self.redirect_url = redirect_url
-        self.raw_html = raw_html
+        if isinstance(raw_html, str):
+            self.payload = None
+            self.charset = None
+            self.raw_html = raw_html
+        else:
+            self.payload = raw_html
+            self.charset = souper.normalize_charset(charset) if charset \
+                else souper.sniff_charset(bytes(raw_html[:souper.SNIFF_BYTES]))
         self.no_version = no_version
         self.ip = ip
         self.timestamp = timestamp
@@ -50,12 +69,50 @@ class WebPage:
         self.content_language = content_language
         self.last_modified = last_modified
         self.etag = etag
+        self.truncated = truncated
+        self._parsed = None  # (text, links, tags) and the ParsedHtml, see parse
+
+    @property
+    def fields(self) -> dict:
+        """
+        The constructor arguments of the page, e.g. to recreate it in another process.
+        """
+        raw_html = self.raw_html if self.payload is None else bytes(self.payload)
+        return dict(orig_url=self.original_url, redirect_url=self.redirect_url, raw_html=raw_html, ip=self.ip,
+                    timestamp=self.timestamp, geo_loc=self.geo_loc, content_language=self.content_language,
+                    last_modified=self.last_modified, etag=self.etag, no_version=self.no_version,
+                    truncated=self.truncated, charset=self.charset)
+
+    @cached_property
+    def raw_html(self) -> str:
+        """
+        The HTML of the page, decoded from the payload on first use.
+        """
+        return souper.decode_page(self.payload, self.charset, self.truncated)
+
+    @property
+    def source(self) -> Union[str, bytes, memoryview]:
+        """
+        The HTML as it was given, the payload if it has not been decoded.
+        """
+        return self.raw_html if self.payload is None else self.payload
+
+    @property
+    def html_bytes(self) -> bytes:
+        """
+        The HTML encoded as UTF-8, which is what pycld2 takes. The payload itself if it already is UTF-8.
+        """
+        if self.payload is not None and self.charset in ("utf-8", "utf-8-sig"):
+            payload = bytes(self.payload)  # Not copied if already bytes
+            return payload[len(codecs.BOM_UTF8):] if self.charset == "utf-8-sig" else payload
+        return self.raw_html.encode("utf-8", errors="replace")
 
     @staticmethod
-    def from_url(url: str):
+    def from_url(url: str, max_bytes: Optional[int] = None):
         """
         Creates a WebPage object from a URL
         :param url: URL to create object from.
+        :param max_bytes: bytes to download at most, defaults to config.MAX_PAGE_BYTES.
         :return: a new WebPage object containing the information from the URL.
         """
         req = Request(url=url, headers=souper.HEADERS)
@@ -64,87 +121,168 @@ class WebPage:
         http_headers = conn.info()
         content_language = http_headers["content-language"]
         etag = http_headers["etag"]
-        last_modified = http_headers["last-modified"]
-        if last_modified:
-            try:
-                last_modified = int(parser.parse(last_modified).astimezone(UTC).timestamp())
-            except ParserError:
-                last_modified = None
-        html = str(conn.read(), "utf-8", errors="replace")
+        last_modified = WebPage.parse_last_modified(http_headers["last-modified"])
+        reader = souper.PageReader(http_headers["content-type"], max_bytes)
+        while (chunk := conn.read(souper.CHUNK_SIZE)) and reader.feed(chunk):
+            pass
         redir = conn.geturl()
         ip = souper.get_ip(conn)
 
         del conn  # Disconnect
-        return WebPage(orig_url=url, redirect_url=redir, raw_html=html, geo_loc=None, ip=ip, timestamp=stamp,
-                       content_language=content_language, last_modified=last_modified, etag=etag)
+        return WebPage(orig_url=url, redirect_url=redir, raw_html=reader.payload(), geo_loc=None, ip=ip,
+                       timestamp=stamp, content_language=content_language, last_modified=last_modified, etag=etag,
+                       truncated=reader.truncated, charset=reader.charset)
 
     @staticmethod
-    def norvegica_score(resp: dict) -> float:
+    async def from_url_async(url: str, session: Optional[aiohttp.ClientSession] = None, etag: Optional[str] = None,
+                             last_modified: Optional[int] = None,
+                             max_bytes: Optional[int] = None) -> Optional["WebPage"]:
         """
-        Gives a score of how Norwegian a page is, normalized between 0 and 1
+        Creates a WebPage object from a URL without blocking the event loop.
+        :param url: URL to create object from.
+        :param session: session to fetch with, defaults to the shared pooled session.
+        :param etag: ETag of a previously fetched version, sent as If-None-Match.
+        :param last_modified: Last-Modified timestamp of a previously fetched version, sent as If-Modified-Since.
+        :param max_bytes: bytes to download at most, defaults to config.MAX_PAGE_BYTES.
+        :return: a new WebPage object containing the information from the URL, or None if it was not modified.
         """
-        norwegian = resp["language"]["norwegian_score"] * 2
+        session = session or souper.get_session()
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = formatdate(last_modified, usegmt=True)
+
+        with metrics.timed("fetch"):
+            async with session.get(url, headers=headers) as resp:
+                if resp.status == HTTPStatus.NOT_MODIFIED:
+                    return None
+                resp.raise_for_status()
+                stamp = int(datetime.utcnow().timestamp())
+                content_language = resp.headers.get("content-language")
+                etag = resp.headers.get("etag")
+                last_modified = WebPage.parse_last_modified(resp.headers.get("last-modified"))
+                ip = await souper.get_ip_async(resp)  # Before reading, while the connection is still held
+                reader = souper.PageReader(resp.headers.get("content-type"), max_bytes)
+                async for chunk in resp.content.iter_chunked(souper.CHUNK_SIZE):
+                    if not reader.feed(chunk):
+                        break
+                redir = str(resp.url)
+
+        return WebPage(orig_url=url, redirect_url=redir, raw_html=reader.payload(), geo_loc=None, ip=ip,
+                       timestamp=stamp, content_language=content_language, last_modified=last_modified, etag=etag,
+                       truncated=reader.truncated, charset=reader.charset)
 
-        reg = resp["regex"]
-        postal = souper.normalize(reg["postal"]["unique"], 1, 2.0)
-        phone = souper.normalize(reg["phone"]["unique"], 1, 1.3)
-        mail = souper.normalize(reg["email"]["unique"], 1, 1.2)
-        county = souper.normalize(reg["county"]["total"], 1, 1.1)
-        norway = souper.normalize(reg["norway"]["total"], 2, 1.1)
+    @staticmethod
+    def parse_last_modified(last_modified: Optional[str]) -> Optional[int]:
+        """
+        Converts a Last-Modified header value to a UTC timestamp, or None if missing or malformed.
+        """
+        if not last_modified:
+            return None
+        try:
+            return int(parser.parse(last_modified).astimezone(UTC).timestamp())
+        except ParserError:
+            return None
+
+    @staticmethod
+    def norvegica_score(resp: dict, weights: Optional[dict] = None) -> float:
+        """
+        Gives a score of how Norwegian a page is, normalized between 0 and 1
+        :param weights: defaults to souper.SCORE_WEIGHTS.
+        """
+        w = weights or souper.SCORE_WEIGHTS
+        flags = WebPage.score_flags(resp)
+        score = resp["language"]["norwegian_score"] * w["language"]
 
         # Give less weight for other countries that
         # - Use kr as currency symbol
         # - Share some common names
-        mul = 1
-        if souper.pattern_kr_dom.fullmatch(resp["domain"]) \
-                or souper.pattern_kr_dom.fullmatch(resp["geo"]) \
-                or souper.pattern_kr_lan.fullmatch(resp["language"]["details"]["0"]["language_code"]):
-            mul = 0.1
-        kroner = souper.normalize(reg["kroner"]["total"], 1, 0.1 * mul)
-        names = souper.normalize(reg["name"]["unique"], 1, 0.5 * mul)
+        mul = w["kr_country"] if flags["kr_country"] else 1
+        reg = resp["regex"]
+        for name in souper.SCORE_FEATURES:
+            count, midpoint, lim = w[name]
+            score += souper.normalize(reg[name][count], midpoint, lim * mul if name in souper.KR_FEATURES else lim)
 
-        geo_score = 0.25 if resp["geo"] == "NO" else 0.0
-        cl_score = 0.25 if souper.pattern_no_html_lang.search(resp["content_language"] or "") else 0.0
-        hl_score = 0.25 if souper.pattern_no_html_lang.search(resp["html_lang"] or "") else 0.0
+        for flag in ("geo", "content_language", "html_lang"):
+            score += w[flag] if flags[flag] else 0.0
 
-        score = norwegian + postal + phone + county + names + norway + mail + kroner + geo_score + cl_score + hl_score
-        score = souper.normalize(score, 1.0)
+        return souper.normalize(score, w["midpoint"])
 
-        return score
+    @staticmethod
+    def score_flags(resp: dict) -> dict:
+        """
+        The yes/no features of norvegica_score, from the other fields of extra_info.
+        """
+        return {
+            "kr_country": bool(patterns.pattern_kr_dom.fullmatch(resp["domain"])
+                               or patterns.pattern_kr_dom.fullmatch(resp["geo"] or "")
+                               or patterns.pattern_kr_lan.fullmatch(resp["language"]["details"]["0"]["language_code"])),
+            "geo": resp["geo"] == "NO",
+            "content_language": bool(patterns.pattern_no_html_lang.search(resp["content_language"] or "")),
+            "html_lang": bool(patterns.pattern_no_html_lang.search(resp["html_lang"] or "")),
+        }
 
-    @cached_property
-    def text(self):
-        return souper.get_text(self.raw_html)
+    def parse(self, text: bool = True, links: bool = True, tags: bool = True) -> souper.ParsedHtml:
+        """
+        Parses the page for some of the extractors, see souper.parse_html.
+        An earlier parse of the page is reused if it has everything needed, else the page is parsed again for both.
+        """
+        wanted = text, links, tags
+        if self._parsed is not None:
+            done, parsed = self._parsed
+            if all(d or not w for d, w in zip(done, wanted)):
+                return parsed
+            wanted = tuple(d or w for d, w in zip(done, wanted))
+        parsed = souper.parse_html_memo(self.raw_html, text=wanted[0], links=wanted[1], tags=wanted[2])
+        self._parsed = wanted, parsed
+        return parsed
+
+    @property
+    def text(self) -> str:
+        """
+        The visible text of the page, see parse.
+        """
+        return self.parse(links=False, tags=False).text
+
+    @property
+    def links(self) -> list:
+        """
+        The hrefs of the links of the page, see parse.
+        """
+        return self.parse(text=False, tags=False).links
 
     @cached_property
     def extra_info(self) -> dict:
         """
         Retrieves relevant information from the page.
         """
-        dom = souper.get_domain(self.redirect_url)
-
-        txt = self.text
-
-        soup = bs4.BeautifulSoup(self.raw_html, "html.parser")
-        links = [link.get("href") for link in soup.find_all("a", attrs={"href": True})]
-        tag = soup.find("html")
-        html_lang = tag.get("lang") if tag else None
+        return self.info()
 
-        language = souper.detect_language(self.raw_html, txt, dom, self.content_language)
-        no_per, no_score = souper.norwegian_score(language["is_reliable"], language["details"])
-        nor_score = souper.normalize(language["text_bytes_found"] * no_per * no_score, 1e7)  # 200*100*500 gives 50%
-        language["norwegian_score"] = nor_score
-
-        postal = souper.has_postal(txt)
-        phone = souper.has_phone_number(txt)
-        county = souper.has_county(txt)
-        name = souper.has_name(txt)
-        norway = souper.has_norway(txt)
-        kroner = souper.has_kroner(txt)
-        email = souper.has_email(txt)
+    def info(self, select: Optional[Iterable[str]] = None) -> dict:
+        """
+        Retrieves some of the information from extra_info, and only computes what those fields need.
 
-        no_version = self.norwegian_version()
+        :param select: the fields to include, see FIELDS. All of them if None.
+        :return: the selected fields, in the order of FIELDS.
+        """
+        wanted = set(self.FIELDS if select is None else select)
+        unknown = wanted.difference(self.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields {sorted(unknown)}, expected some of {list(self.FIELDS)}")
+
+        start = time.perf_counter()
+        score = "norvegica_score" in wanted
+        need_language = score or "language" in wanted
+        need_regex = score or "regex" in wanted
+        need_text = need_language or need_regex or "text" in wanted
+        need_links = "links" in wanted
+        need_tags = "norwegian_version" in wanted
+        parsed = None
+        if need_text or need_links or need_tags or score or "html_lang" in wanted:
+            parsed = self.parse(text=need_text, links=need_links, tags=need_tags)
 
+        dom = souper.get_domain(self.redirect_url)
         response = OrderedDict(
             original_url=self.original_url,
             redirect_url=self.redirect_url,
@@ -155,29 +293,171 @@ class WebPage:
             content_language=self.content_language,
             last_modified=self.last_modified,
             etag=self.etag,
-            html_lang=html_lang,
-            language=language,
-            norwegian_version=no_version,
+            truncated=self.truncated,
+            html_lang=parsed.html_lang if parsed else None,
         )
 
-        response["regex"] = {
+        if need_language:
+            response["language"] = self._language(parsed.text, dom)
+
+        if need_tags:
+            with metrics.timed("norwegian_version"):
+                response["norwegian_version"] = self.norwegian_version()
+
+        if need_regex:
+            response["regex"] = self._regex(parsed.text)
+
+        if score:
+            with metrics.timed("score"):
+                response["norvegica_score"] = self.norvegica_score(response)
+
+        if need_links:
+            response["links"] = "\t".join(parsed.links)
+        if "text" in wanted:
+            response["text"] = parsed.text
+
+        metrics.observe(metrics.STAGE_SECONDS, time.perf_counter() - start, stage="extra_info")
+        metrics.observe(metrics.PAGE_SIZE, len(self.source))
+        if select is None:
+            return response
+        return OrderedDict((k, v) for k, v in response.items() if k in wanted)
+
+    def _language(self, text: str, domain: str) -> dict:
+        """
+        The language field of extra_info.
+        """
+        with metrics.timed("detect_language"):
+            language = souper.detect_language_memo(self.html_bytes, text, domain, self.content_language)
+        no_per, no_score = souper.norwegian_score(language["is_reliable"], language["details"])
+        nor_score = souper.normalize(language["text_bytes_found"] * no_per * no_score, 1e7)  # 200*100*500 gives 50%
+        language["norwegian_score"] = nor_score
+        return language
+
+    def _regex(self, text: str) -> dict:
+        """
+        The regex field of extra_info.
+        With config.SCAN_GUARDED, each feature also has the "ratio" of the text scanned, and its total is extrapolated
+        from that part. The unique count is the number found.
+        """
+        if not config.SCAN_GUARDED:
+            return self._counts(souper.scan_features_memo(text))
+        features, ratios = souper.scan_features_guarded_memo(text)
+        regex = self._counts(features)
+        for name, ratio in ratios.items():
+            if ratio < 1:
+                regex[name]["total"] = round(regex[name]["total"] / ratio) if ratio else 0
+            regex[name]["ratio"] = ratio
+        return regex
+
+    @staticmethod
+    def _counts(features: dict) -> dict:
+        """
+        The regex field of extra_info, from the Counters of the features.
+        """
+        return {
             name: {
                 "unique": len(counter),
                 "total": sum(counter.values())
             }
-            for name, counter in
-            [("postal", postal), ("phone", phone), ("county", county), ("name", name), ("norway", norway),
-             ("kroner", kroner), ("email", email)]
+            for name, counter in features.items()
         }
 
-        no_score = self.norvegica_score(response)
-
-        response["norvegica_score"] = no_score
-        response["links"] = "\t".join(links)
-        response["text"] = txt
+    def cascade(self, thresholds: Optional[Iterable[float]] = None, weights: Optional[dict] = None) -> dict:
+        """
+        Decides whether norvegica_score reaches each threshold, for bulk classification where the score itself is not
+        needed. The features are found in increasing order of cost, see CASCADE_STAGES, and the rest are skipped as soon
+        as the bounds of the score, see norvegica_score_bounds, are on the same side of every threshold.
+
+        :param thresholds: defaults to config.CASCADE_THRESHOLDS.
+        :param weights: defaults to souper.SCORE_WEIGHTS.
+        :return: the fields of extra_info that were found, the bounds of the score, the score if every stage ran,
+                 whether the score reaches each threshold, and the stages that ran and were skipped.
+        """
+        thresholds = list(config.CASCADE_THRESHOLDS if thresholds is None else thresholds)
+        response = OrderedDict(
+            original_url=self.original_url,
+            redirect_url=self.redirect_url,
+            geo=self.geo_loc,
+            domain=souper.get_domain(self.redirect_url),
+            content_language=self.content_language,
+        )
 
+        parsed = None
+        stages = []
+        for stage in self.CASCADE_STAGES:
+            low, high = self.norvegica_score_bounds(response, weights)
+            if all(low >= t or high < t for t in thresholds):
+                break
+            stages.append(stage)
+            if stage == "parse":
+                parsed = self.parse(links=False, tags=False)
+                response["html_lang"] = parsed.html_lang
+            elif stage == "postal":
+                # Guarded, the features are scanned together, as in info, and the regex stage reuses the scan.
+                # Otherwise has_postal finds the same as scan_features, without scanning for the other features
+                response["regex"] = {"postal": self._regex(parsed.text)["postal"]} if config.SCAN_GUARDED \
+                    else self._counts({"postal": souper.has_postal(parsed.text)})
+            elif stage == "language":
+                response["language"] = self._language(parsed.text, response["domain"])
+            elif stage == "regex":
+                response["regex"] = self._regex(parsed.text)
+
+        skipped = [stage for stage in self.CASCADE_STAGES if stage not in stages]
+        for stage in skipped:
+            metrics.inc(metrics.CASCADE_SKIPPED, stage=stage)
+        low, high = self.norvegica_score_bounds(response, weights)
+        response["norvegica_score_bounds"] = [low, high]
+        response["norvegica_score"] = None if skipped else self.norvegica_score(response, weights)
+        response["decisions"] = [low >= t for t in thresholds]
+        response["stages"] = stages
+        response["skipped"] = skipped
         return response
 
+    @staticmethod
+    def norvegica_score_bounds(resp: dict, weights: Optional[dict] = None) -> Tuple[float, float]:
+        """
+        The lowest and highest norvegica_score a page can get, from the fields of extra_info found so far.
+        The html_lang and language may be missing, as may any of the features in regex.
+        Once all are there, both bounds are the score.
+        """
+        w = weights or souper.SCORE_WEIGHTS
+        low = high = 0.0
+        if "language" in resp:
+            low = high = resp["language"]["norwegian_score"] * w["language"]
+        else:
+            high += w["language"]
+
+        kr_country = patterns.pattern_kr_dom.fullmatch(resp["domain"]) \
+            or patterns.pattern_kr_dom.fullmatch(resp["geo"] or "")
+        if kr_country or "language" in resp:
+            kr_country = kr_country or patterns.pattern_kr_lan.fullmatch(
+                resp["language"]["details"]["0"]["language_code"])
+            low_mul = high_mul = w["kr_country"] if kr_country else 1
+        else:  # Not known before the language
+            low_mul, high_mul = sorted((w["kr_country"], 1))
+
+        reg = resp.get("regex", {})
+        for name in souper.SCORE_FEATURES:
+            count, midpoint, lim = w[name]
+            low_lim, high_lim = (lim * low_mul, lim * high_mul) if name in souper.KR_FEATURES else (lim, lim)
+            if name in reg:
+                low += souper.normalize(reg[name][count], midpoint, low_lim)
+                high += souper.normalize(reg[name][count], midpoint, high_lim)
+            else:
+                high += high_lim
+
+        flags = {
+            "geo": resp["geo"] == "NO",
+            "content_language": bool(patterns.pattern_no_html_lang.search(resp["content_language"] or "")),
+            "html_lang": bool(patterns.pattern_no_html_lang.search(resp["html_lang"] or "")) if "html_lang" in resp
+            else None,
+        }
+        for flag, value in flags.items():
+            low += w[flag] if value else 0.0
+            high += w[flag] if value or value is None else 0.0
+
+        return souper.normalize(low, w["midpoint"]), souper.normalize(high, w["midpoint"])
+
     def find_norwegian_links(self) -> dict:
         """
         Finds possible candidates for a Norwegian version of the page.
@@ -193,7 +473,7 @@ class WebPage:
         # Either already_no or replace, not both.
         if url_parts[-1] == "no":
             schemes_links[souper.ALREADY_NO].append(self.redirect_url)
-        else:
+        elif len(url_parts) > 1:  # Pages without a URL have no domain to replace
             new_url_parts = list(url_parts)
             if url_parts[-2] in {"com", "co"}:  # E.g. co.uk -> no instead of co.no
                 del new_url_parts[-1]
@@ -207,85 +487,65 @@ class WebPage:
 
             schemes_links[souper.REPLACE].append(new_url)
 
-        soup = bs4.BeautifulSoup(self.raw_html, "html.parser")
-
-        for tag in soup.find_all(["a", "link"]):
-            schemes_links[souper.place_tag(tag)].append(tag.get("href"))
+        for scheme, href in self.parse(text=False, links=False).tag_links:
+            schemes_links[scheme].append(href)
 
         return schemes_links
 
-    def norwegian_version(self, norwegian_links: Optional[dict] = None) -> dict:
+    def norwegian_candidates(self, norwegian_links: Optional[dict] = None) -> list:
         """
-        Goes through candidates for Norwegian versions, and selects the best one that actually exists.
-
-        :return: a dict containing the scheme in which it was discovered,
-                 the number of matching bytes, and the URL of the page.
-        """
-
-        # Internal method that attempts to establish a connection to new URL
-        def try_url(new_u):
-            try:
-                new_connection = urlopen(Request(url=new_u, headers=souper.HEADERS), timeout=30)
-
-                status = new_connection.getcode()
-                if (status == HTTPStatus.OK
-                        or status == HTTPStatus.MOVED_PERMANENTLY
-                        or status == HTTPStatus.FOUND):
-                    ip_o = souper.get_ip(new_connection)
-                    ip_n = self.ip
-
-                    i = 0
-                    for o, n in zip(ip_o.split("."), ip_n.split(".")):
-                        if o == n:
-                            i += 1
-                        else:
-                            break
-                    return i, new_connection.geturl()
-            except (HTTPError, CertificateError, URLError, ConnectionResetError, IncompleteRead, socket.timeout,
-                    socket.gaierror):
-                pass
-            return None
+        Lists the candidates for a Norwegian version in the order they should be tried.
 
+        :param norwegian_links: the result of find_norwegian_links, found if None.
+        :return: a list of (scheme, url), ordered by scheme from best to worst. Relative links have "/" before the
+                 scheme. The page itself is the last candidate if it is already .no.
+        """
         schemes_links = norwegian_links or self.find_norwegian_links()
 
+        candidates = []
         for scheme in souper.SCHEMES:
             # Since ALREADY_NO is uninteresting and quite trivial we ignore it to get something more meaningful
             if scheme != souper.NO_MATCH and scheme != souper.ALREADY_NO:
                 # Reverse sorting puts links starting with "/" at the end
-                links = sorted(schemes_links[scheme], reverse=True)
-                queue = None  # Queue is for matches where the url is the same as the original result
-                for link in links:
+                for link in sorted(schemes_links[scheme], reverse=True):
                     if link.startswith("/"):
                         parsed = urlparse(self.redirect_url)
                         new_url = urlunparse((parsed.scheme, parsed.netloc, link, None, None, None))
-                        sch = "/" + scheme
+                        candidates.append(("/" + scheme, new_url))
                     else:
-                        sch = scheme
-                        new_url = link
+                        candidates.append((scheme, link))
 
-                    if new_url == self.original_url or new_url == self.redirect_url:
-                        queue = sch
-                    else:
-                        # res = try_url(new_url)
-                        res = new_url, -1
-                        if res:
-                            return {"url": res[1], "scheme": sch, "ip_match": res[0]}
-                if queue:
-                    return {"url": self.redirect_url, "scheme": queue, "ip_match": 4}
+        candidates.extend((souper.ALREADY_NO, link) for link in schemes_links[souper.ALREADY_NO])
+        return candidates
+
+    def is_self(self, url: str) -> bool:
+        return url == self.original_url or url == self.redirect_url
+
+    def norwegian_version(self, norwegian_links: Optional[dict] = None) -> dict:
+        """
+        Selects the best candidate for a Norwegian version, without checking that it exists.
+        See probe.Prober.norwegian_version for the verified version.
 
-        if schemes_links[souper.ALREADY_NO]:
-            return {"url": self.redirect_url, "scheme": souper.ALREADY_NO, "ip_match": 4}
+        :return: a dict containing the scheme in which it was discovered,
+                 the number of matching IPv4 bytes (-1 if not checked), and the URL of the page.
+        """
+        for scheme, group in groupby(self.norwegian_candidates(norwegian_links), key=lambda c: c[0].lstrip("/")):
+            queue = None  # Queue is for matches where the url is the same as the original result
+            for sch, url in group:
+                if self.is_self(url):
+                    queue = sch
+                else:
+                    return {"url": url, "scheme": sch, "ip_match": -1}
+            if queue:
+                return {"url": self.redirect_url, "scheme": queue, "ip_match": 4}
 
         return {"url": None, "scheme": souper.NO_MATCH, "ip_match": 0}
 
-    def diff(self, other: "WebPage") -> Tuple[set, set, set, set]:
-        t1, t2 = self.text.split("\t"), other.text.split("\t")
-        chars = " +-?"
-        sets = set(), set(), set(), set()  # same, added, removed, neither
-        for comp in difflib.Differ().compare(t1, t2):
-            line = comp[2:]
-            first = comp[0]
-            for c, s in zip(chars, sets):
-                if first == c:
-                    s.add(line)
-        return sets
+    def diff(self, other: "WebPage", hints: bool = True) -> Tuple[set, set, set, set]:
+        """
+        Compares the lines of text of two harvests of a page, see textdiff.diff_lines.
+        :param hints: also find the "?" hints of lines that changed only slightly, which gives the same sets as
+                      difflib.Differ but is much slower, see textdiff.diff_lines.
+        :return: the sets of lines that are the same, added, removed, and the hints.
+        """
+        return textdiff.diff_lines(self.text.split("\t"), other.text.split("\t"), hints)
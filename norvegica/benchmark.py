@@ -0,0 +1,374 @@
+"""
+Micro benchmarks for the norvegica feature extraction.
+Run from the repository root, e.g. `python norvegica/benchmark.py place_tags --links 5000`
+
+The suite benchmark measures every stage over a generated corpus, which is the same for the same seed and scale,
+e.g. `python norvegica/benchmark.py suite --output before.json`, and `--baseline before.json` compares to a saved run.
+Run it with NORVEGICA_PARSER=bs4 to compare the parsers, and `check` to verify they give the same results,
+and that textdiff.diff_lines gives the same as difflib.
+"""
+import argparse
+import difflib
+import json
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime
+
+from bs4 import BeautifulSoup
+
+import config
+import patterns
+import souper
+import textdiff
+from WebPage import WebPage
+
+LINK_TEXTS = ["Norsk", "English", "Deutsch", "Norwegian version", "Kontakt oss", "Nyheter", "Om oss", "Norge",
+              "Svenska", "Read more", "Bokmål", "Logg inn"]
+LINK_HREFS = ["/no/", "/en/", "/de/", "/norge/nyheter", "/kontakt", "https://example.com/about", "/sv/", "#top"]
+
+
+def link_heavy_page(n_links: int, seed: int = 0) -> str:
+    """
+    Generates a page with mostly <a> and some <link> tags, like a large portal front page.
+    """
+    rnd = random.Random(seed)
+    head = ['<link rel="alternate" hreflang="%s" href="/%s/">' % (lang, lang) for lang in ("nb", "en", "de", "sv")]
+    body = []
+    for _ in range(n_links):
+        attrs = f'href="{rnd.choice(LINK_HREFS)}"'
+        if rnd.random() < 0.1:
+            attrs += f' hreflang="{rnd.choice(["nb", "en", "de"])}"'
+        if rnd.random() < 0.2:
+            attrs += f' title="{rnd.choice(LINK_TEXTS)}"'
+        body.append(f'<li><a {attrs}><span>{rnd.choice(LINK_TEXTS)}</span> {rnd.choice(LINK_TEXTS)}</a></li>')
+    return f"<html><head>{''.join(head)}</head><body><ul>{''.join(body)}</ul></body></html>"
+
+
+def bench_place_tags(n_links: int, repeat: int, purge: bool = False):
+    """
+    :param purge: purge the re module's cache before each tag, as the many other patterns in the process do.
+    """
+    tags = BeautifulSoup(link_heavy_page(n_links), "html.parser").find_all(["a", "link"])
+
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        per_tag = []
+        for t in tags:
+            if purge:
+                re.purge()
+            per_tag.append(souper.place_tag(t))
+    t1 = time.perf_counter()
+    for _ in range(repeat):
+        batch = souper.place_tags(tags)
+    t2 = time.perf_counter()
+
+    assert per_tag == batch, "place_tags differs from place_tag"
+    n = len(tags) * repeat
+    print(f"{len(tags)} tags, {repeat} repeats")
+    print(f"place_tag:  {n / (t1 - t0):10.0f} tags/s")
+    print(f"place_tags: {n / (t2 - t1):10.0f} tags/s")
+
+
+# Words to generate text from, with the features the regexes look for
+NORWEGIAN_WORDS = ["og", "i", "det", "som", "på", "er", "en", "til", "med", "for", "har", "av", "ikke", "vi", "kan",
+                   "nyheter", "kommune", "skole", "været", "fjellet", "blåbær", "søknad", "tjenester", "øvelse",
+                   "åpningstider", "kontakt", "oss", "hjemme", "byen", "sommer"]
+ENGLISH_WORDS = ["the", "and", "of", "to", "in", "is", "for", "on", "with", "news", "about", "contact", "services",
+                 "opening", "hours", "weather", "school", "city", "summer", "read", "more"]
+FEATURES = ["0150 Oslo", "5003 Bergen", "+47 22 33 44 55", "post@example.no", "Norge", "Vestland", "Viken",
+            "kr 1 500", "299 kroner", "Ola Nordmann", "Kari Hansen"]
+
+# A page of the corpus, as downloaded, and decoded
+Page = namedtuple("Page", ["kind", "payload", "charset", "html", "text"])
+
+
+def paragraphs(rnd: random.Random, n: int, words: list, features: float = 0.05) -> list:
+    """
+    Generates paragraphs of random words, with a share of them replaced by features.
+    """
+    out = []
+    for _ in range(n):
+        length = rnd.randint(20, 120)
+        out.append(" ".join(rnd.choice(FEATURES) if rnd.random() < features else rnd.choice(words)
+                            for _ in range(length)).capitalize() + ".")
+    return out
+
+
+def text_page(rnd: random.Random, n_paragraphs: int, words: list, charset: str = "utf-8") -> str:
+    body = "".join(f"<p>{p}</p>" for p in paragraphs(rnd, n_paragraphs, words))
+    nav = "".join(f'<a href="/{w}/">{w.capitalize()}</a>' for w in rnd.sample(words, 5))
+    return (f'<html lang="no"><head><meta charset="{charset}"><title>{rnd.choice(words)}</title></head>'
+            f"<body><nav>{nav}</nav><main>{body}</main></body></html>")
+
+
+def script_heavy_page(rnd: random.Random) -> str:
+    """
+    Generates a page of mostly inline scripts and styles, with little visible text, like a single page app.
+    """
+    scripts = "".join("<script>var %s = %s;</script>" % (f"v{i}", json.dumps([rnd.random() for _ in range(400)]))
+                      for i in range(40))
+    styles = "".join(f".c{i} {{ margin: {i}px; color: #{rnd.randrange(1 << 24):06x}; }}" for i in range(3000))
+    body = "".join(f"<p>{p}</p>" for p in paragraphs(rnd, 3, NORWEGIAN_WORDS))
+    return f"<html><head><style>{styles}</style>{scripts}</head><body><div id='app'>{body}</div></body></html>"
+
+
+CORPUS = {
+    # Kind: number of pages at scale 1, and how to make one
+    "small": (40, lambda rnd: text_page(rnd, 5, NORWEGIAN_WORDS).encode("utf-8")),
+    "english": (20, lambda rnd: text_page(rnd, 8, ENGLISH_WORDS).encode("utf-8")),
+    "huge": (2, lambda rnd: text_page(rnd, 12000, NORWEGIAN_WORDS + ENGLISH_WORDS).encode("utf-8")),
+    "link_heavy": (5, lambda rnd: link_heavy_page(3000, rnd.randrange(1 << 30)).encode("utf-8")),
+    "script_heavy": (10, lambda rnd: script_heavy_page(rnd).encode("utf-8")),
+    "latin1": (20, lambda rnd: text_page(rnd, 10, NORWEGIAN_WORDS, "iso-8859-1").encode("cp1252")),
+}
+
+
+def make_corpus(seed: int = 0, scale: float = 1.0) -> list:
+    """
+    Generates the corpus of the suite, the same for the same seed and scale.
+    """
+    rnd = random.Random(seed)
+    pages = []
+    for kind, (count, make) in CORPUS.items():
+        for _ in range(max(1, round(count * scale))):
+            payload = make(rnd)
+            charset = souper.sniff_charset(payload[:souper.SNIFF_BYTES])
+            html = souper.decode_page(payload, charset)
+            pages.append(Page(kind, payload, charset, html, souper.get_text(html)))
+    return pages
+
+
+def analyze(page: Page):
+    souper.clear_memos()  # Measures the whole analysis, not the memos
+    return WebPage(orig_url="http://example.no/", redirect_url="http://example.no/", raw_html=page.payload, ip=None,
+                   charset=page.charset).extra_info
+
+
+# Stage: the function to measure on a page
+STAGES = {
+    "decode": lambda page: souper.decode_page(page.payload, page.charset),
+    "parse_html": lambda page: souper.parse_html(page.html),
+    "get_text": lambda page: souper.get_text(page.html),
+    "detect_language": lambda page: souper.detect_language(page.html, page.text),
+    "scan_features": lambda page: souper.scan_features(page.text),
+    **{f"has_{name}": lambda page, f=f: f(page.text) for name, f in [
+        ("name", souper.has_name), ("postal", souper.has_postal), ("phone_number", souper.has_phone_number),
+        ("norway", souper.has_norway), ("county", souper.has_county), ("kroner", souper.has_kroner),
+        ("email", souper.has_email), ("id_number", souper.has_id_number)]},
+    "extra_info": analyze,
+}
+
+
+def check_parsers(pages: list) -> int:
+    """
+    Compares the results of parse_html and get_text with each parser, see config.PARSER.
+    :return: the number of pages they differ on.
+    """
+    parser = config.PARSER
+    differ = 0
+    try:
+        for page in pages:
+            results = []
+            for config.PARSER in ("stream", "bs4"):
+                results.append((souper.parse_html(page.html), souper.get_text(page.html)))
+            if results[0] != results[1]:
+                differ += 1
+                print(f"The parsers differ on a {page.kind} page", file=sys.stderr)
+    finally:
+        config.PARSER = parser
+    return differ
+
+
+def harvests(rnd: random.Random) -> tuple:
+    """
+    Generates the lines of two harvests of a page, with menu lines that repeat, and some lines removed, added,
+    repeated or slightly changed in the second.
+    """
+    lines = [rnd.choice(LINK_TEXTS) if rnd.random() < 0.4 else p[:rnd.randint(10, 60)]
+             for p in paragraphs(rnd, rnd.randint(0, 40), NORWEGIAN_WORDS)]
+    changed = list(lines)
+    for _ in range(rnd.randint(0, 10)):
+        k = rnd.randrange(len(changed) + 1)
+        edit = rnd.random()
+        if edit < 0.25 and k < len(changed):
+            del changed[k]
+        elif edit < 0.5:
+            changed.insert(k, rnd.choice(LINK_TEXTS))
+        elif edit < 0.75 and k < len(changed):
+            changed.insert(k, changed[k])
+        elif k < len(changed):
+            changed[k] = changed[k].replace(" ", "  ", 1) + rnd.choice(NORWEGIAN_WORDS)
+    return lines, changed
+
+
+def check_diff(seed: int = 0, count: int = 1000) -> int:
+    """
+    Compares textdiff.diff_lines with the hints to difflib.Differ, on pages with repeated lines, see harvests.
+    :return: the number of pages they differ on.
+    """
+    rnd = random.Random(seed)
+    differ = 0
+    for _ in range(count):
+        a, b = harvests(rnd)
+        expected = set(), set(), set(), set()
+        for comp in difflib.Differ().compare(a, b):
+            for c, s in zip(textdiff.SAME + textdiff.ADDED + textdiff.REMOVED + textdiff.HINT, expected):
+                if comp[0] == c:
+                    s.add(comp[2:])
+        if textdiff.diff_lines(a, b) != expected:
+            differ += 1
+            print(f"diff_lines differs from difflib.Differ on {a} and {b}", file=sys.stderr)
+    return differ
+
+
+def read_pages(paths: list) -> list:
+    """
+    Reads saved pages to check, decoded as downloads are.
+    """
+    pages = []
+    for path in paths:
+        with open(path, "rb") as f:
+            payload = f.read()
+        charset = souper.sniff_charset(payload[:souper.SNIFF_BYTES])
+        html = souper.decode_page(payload, charset)
+        pages.append(Page(path, payload, charset, html, None))
+    return pages
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def bench_stage(func, pages: list, repeat: int, memory: bool) -> dict:
+    """
+    Times a stage on every page of the corpus.
+    :param memory: also run the stage once per page under tracemalloc, which is too slow to do while timing.
+    """
+    times = []
+    for _ in range(repeat):
+        for page in pages:
+            t = time.perf_counter()
+            func(page)
+            times.append(time.perf_counter() - t)
+    total = sum(times)
+    size = sum(len(page.payload) for page in pages) * repeat
+    result = {
+        "pages": len(times),
+        "seconds": round(total, 6),
+        "pages_per_s": round(len(times) / total, 3),
+        "mb_per_s": round(size / total / 1e6, 3),
+        "p50_ms": round(percentile(times, 0.5) * 1000, 4),
+        "p99_ms": round(percentile(times, 0.99) * 1000, 4),
+    }
+    if memory:
+        peak = 0
+        tracemalloc.start()
+        try:
+            for page in pages:
+                tracemalloc.reset_peak()
+                func(page)
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+        result["peak_mib"] = round(peak / 2 ** 20, 3)
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(seed: int, scale: float, repeat: int, stages: list, memory: bool) -> dict:
+    # Loading the patterns and expressions is not part of any stage. The GeoIP database is not used, pages have no IP
+    patterns.load()
+    pages = make_corpus(seed, scale)
+    corpus = {}
+    for page in pages:
+        kind = corpus.setdefault(page.kind, {"pages": 0, "bytes": 0})
+        kind["pages"] += 1
+        kind["bytes"] += len(page.payload)
+
+    results = {}
+    for stage in stages:
+        results[stage] = {"all": bench_stage(STAGES[stage], pages, repeat, memory)}
+        for kind in corpus:
+            results[stage][kind] = bench_stage(STAGES[stage], [p for p in pages if p.kind == kind], repeat, False)
+        print(f"{stage:16} {results[stage]['all']['pages_per_s']:10.1f} pages/s "
+              f"{results[stage]['all']['mb_per_s']:8.2f} MB/s  p50 {results[stage]['all']['p50_ms']:9.3f} ms  "
+              f"p99 {results[stage]['all']['p99_ms']:9.3f} ms"
+              + (f"  peak {results[stage]['all']['peak_mib']:8.2f} MiB" if memory else ""), file=sys.stderr)
+
+    return {"commit": git_commit(), "date": datetime.utcnow().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "platform": platform.platform(),
+            "seed": seed, "scale": scale, "repeat": repeat, "corpus": corpus, "stages": results}
+
+
+def compare(result: dict, baseline: dict):
+    """
+    Prints the speedup of each stage over a saved run.
+    """
+    print(f"Compared to {baseline.get('commit')} from {baseline.get('date')}", file=sys.stderr)
+    if (baseline.get("seed"), baseline.get("scale")) != (result["seed"], result["scale"]):
+        print("The corpus differs, run with the same --seed and --scale to compare", file=sys.stderr)
+    for stage, kinds in result["stages"].items():
+        if stage in baseline["stages"]:
+            old, new = baseline["stages"][stage]["all"], kinds["all"]
+            print(f"{stage:16} {new['pages_per_s'] / old['pages_per_s']:6.2f}x pages/s, "
+                  f"p99 {old['p99_ms']:.3f} -> {new['p99_ms']:.3f} ms", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    sub = arg_parser.add_subparsers(dest="benchmark", required=True)
+    place = sub.add_parser("place_tags", help="classify the tags of a link heavy page")
+    place.add_argument("--links", type=int, default=5000)
+    place.add_argument("--repeat", type=int, default=5)
+    place.add_argument("--purge", action="store_true", help="purge the re cache before each place_tag call")
+    suite = sub.add_parser("suite", help="measure every stage over a generated corpus")
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--scale", type=float, default=1.0, help="multiplies the number of pages of each kind")
+    suite.add_argument("--repeat", type=int, default=3)
+    suite.add_argument("--stages", default=",".join(STAGES), help="comma separated stages to run")
+    suite.add_argument("--no-memory", action="store_true", help="skip measuring the peak memory of each stage")
+    suite.add_argument("--output", help="file to write the results to as JSON, printed if not given")
+    suite.add_argument("--baseline", help="results of an earlier run to compare to")
+    check = sub.add_parser("check", help="check that the parsers give the same results on the corpus, "
+                                         "and that diff_lines gives the same as difflib")
+    check.add_argument("pages", nargs="*", help="saved HTML pages to also check")
+    check.add_argument("--seed", type=int, default=0)
+    check.add_argument("--scale", type=float, default=1.0, help="multiplies the number of pages of each kind")
+    args = arg_parser.parse_args()
+
+    if args.benchmark == "place_tags":
+        bench_place_tags(args.links, args.repeat, args.purge)
+    elif args.benchmark == "suite":
+        stages = args.stages.split(",")
+        unknown = set(stages).difference(STAGES)
+        if unknown:
+            arg_parser.error(f"Unknown stages {', '.join(sorted(unknown))}, expected some of {', '.join(STAGES)}")
+        result = bench_suite(args.seed, args.scale, args.repeat, stages, not args.no_memory)
+        if args.baseline:
+            with open(args.baseline) as f:
+                compare(result, json.load(f))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+        else:
+            print(json.dumps(result, indent=2))
+    elif args.benchmark == "check":
+        pages = make_corpus(args.seed, args.scale) + read_pages(args.pages)
+        differ = check_parsers(pages)
+        print(f"The parsers differ on {differ} of {len(pages)} pages")
+        diffs = check_diff(args.seed)
+        print(f"diff_lines differs from difflib.Differ on {diffs} pages")
+        sys.exit(1 if differ or diffs else 0)
@@ -0,0 +1,132 @@
+"""
+Caches for reusing work between requests.
+"""
+import shelve
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from hashlib import blake2b
+from typing import Callable, Optional, Union
+
+# An analysis result together with what is needed to check whether it is still valid
+CachedResult = namedtuple("CachedResult", ["etag", "last_modified", "content_hash", "result"])
+
+
+class LRUCache:
+    """
+    A dict-like cache that evicts the least recently used entries beyond maxsize, and optionally entries older than ttl.
+    Safe to share between threads.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None, max_weight: Optional[float] = None,
+                 weigh: Optional[Callable] = None):
+        """
+        :param maxsize: maximum number of entries.
+        :param ttl: seconds an entry is valid for, forever if None.
+        :param max_weight: maximum total weight of the entries, e.g. to bound their memory. Unbounded if None.
+        :param weigh: gives the weight of a value, required with max_weight.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (expiry, value, weight)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expiry, value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expiry is not None and expiry < time.monotonic():
+                self._pop(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl: Optional[float] = None):
+        """
+        :param ttl: seconds this entry is valid for, instead of the ttl of the cache.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expiry = time.monotonic() + ttl if ttl is not None else None
+        weight = self.weigh(value) if self.max_weight is not None else 0
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = expiry, value, weight
+            self.weight += weight
+            while len(self._data) > self.maxsize or (self.max_weight is not None and self.weight > self.max_weight):
+                self._pop(next(iter(self._data)))
+
+    def _pop(self, key):
+        self.weight -= self._data.pop(key)[2]
+
+    def __contains__(self, key) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and (entry[0] is None or entry[0] >= time.monotonic())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        stats = {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+        if self.max_weight is not None:
+            stats.update(weight=self.weight, max_weight=self.max_weight)
+        return stats
+
+
+class ResultCache:
+    """
+    Analysis results by URL, kept in memory and optionally on disk so they survive restarts.
+    """
+
+    def __init__(self, maxsize: int = 1024, path: Optional[str] = None):
+        """
+        :param maxsize: number of results kept in memory.
+        :param path: file for the on-disk backend, which is not size limited. Results are only kept in memory if None.
+        """
+        self.memory = LRUCache(maxsize)
+        self.disk = shelve.open(path) if path else None
+
+    def get(self, url: str) -> Optional[CachedResult]:
+        entry = self.memory.get(url)
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(url)
+            if entry is not None:
+                self.memory.put(url, entry)
+        return entry
+
+    def put(self, url: str, entry: CachedResult):
+        self.memory.put(url, entry)
+        if self.disk is not None:
+            self.disk[url] = entry
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+
+def content_hash(*parts: Union[str, bytes, None]) -> str:
+    """
+    Hashes strings, e.g. the HTML of a page together with the other inputs of its analysis.
+    Bytes are hashed as they are, the same as a string encoded as UTF-8.
+    """
+    h = blake2b(digest_size=16)
+    for part in parts:
+        h.update(part.encode("utf-8", errors="surrogatepass") if isinstance(part, str) else part or b"")
+        h.update(b"\0")
+    return h.hexdigest()
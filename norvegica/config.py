@@ -0,0 +1,54 @@
+"""
+Settings for the norvegica service, read from environment variables.
+"""
+import os
+
+# Maximum number of pages analyzed at the same time for one /batch request
+BATCH_WORKERS = int(os.environ.get("NORVEGICA_BATCH_WORKERS", 8))
+
+# Where extra_info is computed: "process" (a pool of worker processes), "thread" or "inline" (on the event loop)
+EXECUTOR = os.environ.get("NORVEGICA_EXECUTOR", "process")
+# Number of worker processes or threads, defaults to one per core
+WORKERS = int(os.environ.get("NORVEGICA_WORKERS", 0)) or os.cpu_count()
+
+# Number of /url results kept in memory for revalidation with If-None-Match/If-Modified-Since
+RESULT_CACHE_SIZE = int(os.environ.get("NORVEGICA_RESULT_CACHE_SIZE", 1024))
+# File to also keep the results on disk, e.g. on a persistent volume. Unset to keep them only in memory
+RESULT_CACHE_PATH = os.environ.get("NORVEGICA_RESULT_CACHE_PATH") or None
+
+# Allow profiling single requests with a "profile=1" form field or an "X-Norvegica-Profile: 1" header
+PROFILING = os.environ.get("NORVEGICA_PROFILING", "").lower() in ("1", "true", "yes")
+# Number of functions reported by cumulative time
+PROFILE_TOP = int(os.environ.get("NORVEGICA_PROFILE_TOP", 25))
+# Directory to also write the raw profiles to, unset to not keep them
+PROFILE_DIR = os.environ.get("NORVEGICA_PROFILE_DIR") or None
+
+# Check that the Norwegian version of each page fetched by the server exists, and how many bytes of its IP match the
+# page's IP. Pages given to the server are not probed, as they may be archived
+PROBE = os.environ.get("NORVEGICA_PROBE", "1").lower() in ("1", "true", "yes")
+# Maximum number of candidates probed at the same time for one page, and for one host over all pages
+PROBE_PER_PAGE = int(os.environ.get("NORVEGICA_PROBE_PER_PAGE", 8))
+PROBE_PER_HOST = int(os.environ.get("NORVEGICA_PROBE_PER_HOST", 2))
+# Seconds before a candidate is given up
+PROBE_TIMEOUT = float(os.environ.get("NORVEGICA_PROBE_TIMEOUT", 5))
+# Maximum number of candidates probed for one page, the best ones, and seconds before the page's probes are given up
+PROBE_MAX_CANDIDATES = int(os.environ.get("NORVEGICA_PROBE_MAX_CANDIDATES", 16))
+PROBE_DEADLINE = float(os.environ.get("NORVEGICA_PROBE_DEADLINE", 15))
+
+# How pages are parsed: "stream" extracts the text and links while parsing, see htmlstream.py,
+# "bs4" builds a BeautifulSoup tree first, which gives the same results with many times the memory
+PARSER = os.environ.get("NORVEGICA_PARSER", "stream")
+
+# Scores that WebPage.cascade decides whether pages reach, comma separated
+CASCADE_THRESHOLDS = [float(t) for t in os.environ.get("NORVEGICA_CASCADE_THRESHOLDS", "0.5").split(",")]
+
+# Scan the regex features in bounded time, see souper.scan_features_guarded. The counts are then extrapolated from
+# the part of the text that was scanned, which is recorded as the "ratio" of each feature
+SCAN_GUARDED = os.environ.get("NORVEGICA_SCAN_GUARDED", "").lower() in ("1", "true", "yes")
+# Characters of text scanned at most, longer texts are sampled
+SCAN_MAX_CHARS = int(os.environ.get("NORVEGICA_SCAN_MAX_CHARS", 2 ** 20))
+# Seconds each feature may take before it stops, with the counts found so far
+SCAN_BUDGET = float(os.environ.get("NORVEGICA_SCAN_BUDGET", 0.5))
+
+# Pages are only downloaded up to this size, and marked as truncated
+MAX_PAGE_BYTES = int(os.environ.get("NORVEGICA_MAX_PAGE_BYTES", 10 * 2 ** 20))
@@ -0,0 +1,205 @@
+"""
+Extracts the visible text, links and image sources of HTML in one pass over the html.parser events,
+without building a BeautifulSoup tree. Invisible parts are skipped as they are parsed, instead of extracted afterwards.
+The results are the same as from the tree BeautifulSoup(html, "html.parser") builds, see souper.get_text,
+which is checked by `python norvegica/benchmark.py check`.
+"""
+import re
+from collections import Counter, namedtuple
+from html.parser import HTMLParser
+from typing import Union
+
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import EntitySubstitution, UnicodeDammit
+
+# Tags left out of the text with everything in them, as souper.get_text extracts them
+INVISIBLE_TAGS = frozenset(("style", "script", "head", "title"))
+HIDDEN_STYLE = re.compile("display: ?none|visibility: ?hidden")
+
+# How BeautifulSoup builds the tree
+VOID_TAGS = frozenset(HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS)
+PRESERVE_WHITESPACE_TAGS = frozenset(HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS)
+# Strings in these are of other types than text, e.g. Script, in versions of bs4 that have them
+STRING_CONTAINER_TAGS = frozenset(getattr(HTMLTreeBuilder, "DEFAULT_STRING_CONTAINERS", ()))
+# Attributes split into lists of words, e.g. rel, of the tags collected for place_tags
+LIST_ATTRIBUTES = {tag: set(HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES.get("*", ()))
+                   | set(HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES.get(tag, ())) for tag in ("a", "link")}
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+WINDOWS_1252_CONTROLS = range(0x80, 0xa0)
+
+# strings: the visible text segments, stripped
+# links, images: (href or src, visible) of every <a href> and <img src>
+# html_lang: the lang of the first <html> tag
+# tags: an Element for every <a> and <link> tag, for souper.place_tags
+Extracted = namedtuple("Extracted", ["strings", "links", "images", "html_lang", "tags"])
+
+
+class Element:
+    """
+    The parts of a bs4 Tag that souper.place_tags uses.
+    """
+    __slots__ = ("name", "attrs", "strings")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.strings = []  # Every string in the tag, visible or not, as bs4 get_text finds them
+
+    def get(self, key: str, default=None):
+        return self.attrs.get(key, default)
+
+    def get_text(self, separator: str = "") -> str:
+        return separator.join(self.strings)
+
+
+class StreamExtractor(HTMLParser):
+    """
+    Follows the tags html.parser reports with a stack of the open ones, the way BeautifulSoup builds its tree:
+    an end tag closes the most recent open tag of the same name and everything opened after it, and is ignored if there
+    is none. Each string is then visible unless one of the tags it is in is invisible, as in the extracted tree.
+    """
+
+    def __init__(self, tags: bool = False):
+        """
+        :param tags: also collect the <a> and <link> tags, with the text of the <a> tags.
+        """
+        super().__init__(convert_charrefs=False)  # As bs4, which resolves the references itself
+        self.collect_tags = tags
+        self.strings = []
+        self.links = []
+        self.images = []
+        self.html_lang = None
+        self.tags = []
+
+        # One (name, hidden, preserve whitespace, string container, Element or None) per open tag,
+        # where the flags also cover the tags it is in
+        self._stack = [("[document]", False, False, False, None)]
+        self._open = Counter()
+        self._anchors = []  # Elements of the open <a> tags, which get the text inside them
+        self._closed_void = []  # Void tags closed by their start tag, whose end tag is then ignored
+        self._data = []
+        self._seen_html = False
+
+    def handle_starttag(self, tag: str, attrs: list, void: bool = True):
+        self._end_data()
+        attributes = {}
+        for key, value in attrs:
+            attributes[key] = "" if value is None else value
+        _, hidden, preserve, container, _ = self._stack[-1]
+        hidden = hidden or tag in INVISIBLE_TAGS or bool(HIDDEN_STYLE.search(attributes.get("style", "")))
+
+        if tag == "html" and not self._seen_html:
+            self._seen_html = True
+            self.html_lang = attributes.get("lang")
+        elif tag == "a" and "href" in attributes:
+            self.links.append((attributes["href"], not hidden))
+        elif tag == "img" and "src" in attributes:
+            self.images.append((attributes["src"], not hidden))
+
+        element = None
+        if self.collect_tags and tag in ("a", "link"):
+            for key in LIST_ATTRIBUTES[tag]:
+                if key in attributes:
+                    attributes[key] = attributes[key].split()
+            element = Element(tag, attributes)
+            self.tags.append(element)
+            if tag == "a":
+                self._anchors.append(element)
+
+        self._stack.append((tag, hidden, preserve or tag in PRESERVE_WHITESPACE_TAGS,
+                            container or tag in STRING_CONTAINER_TAGS, element))
+        self._open[tag] += 1
+        if void and tag in VOID_TAGS:
+            self._pop_to(tag)
+            self._closed_void.append(tag)
+
+    def handle_startendtag(self, tag: str, attrs: list):
+        # <tag/> is closed at once, whatever the tag
+        self.handle_starttag(tag, attrs, void=False)
+        self._end_data()
+        self._pop_to(tag)
+
+    def handle_endtag(self, tag: str):
+        if tag in self._closed_void:
+            self._closed_void.remove(tag)
+        else:
+            self._end_data()
+            self._pop_to(tag)
+
+    def handle_data(self, data: str):
+        self._data.append(data)
+
+    def handle_charref(self, name: str):
+        number = int(name[1:], 16) if name[:1] in "xX" else int(name)
+        if number == 0 or number > 0x10ffff or 0xd800 <= number <= 0xdfff:
+            char = "\ufffd"
+        elif number in WINDOWS_1252_CONTROLS and number in UnicodeDammit.WINDOWS_1252_TO_UTF8:
+            char = UnicodeDammit.WINDOWS_1252_TO_UTF8[number].decode("utf8")
+        else:
+            char = chr(number)
+        self._data.append(char)
+
+    def handle_entityref(self, name: str):
+        self._data.append(EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name, "&" + name))
+
+    def unknown_decl(self, data: str):
+        self._end_data()
+        if data.upper().startswith("CDATA["):
+            self._data.append(data[len("CDATA["):])
+            self._end_data(cdata=True)
+
+    # Comments, doctypes and processing instructions are not text, but end the string before them
+    def handle_comment(self, data: str):
+        self._end_data()
+
+    def handle_decl(self, decl: str):
+        self._end_data()
+
+    def handle_pi(self, data: str):
+        self._end_data()
+
+    def close(self):
+        super().close()
+        self._end_data()
+
+    def _pop_to(self, tag: str):
+        if not self._open[tag]:
+            return
+        while True:
+            name, _, _, _, element = self._stack.pop()
+            self._open[name] -= 1
+            if element is not None and element.name == "a":
+                self._anchors.pop()
+            if name == tag:
+                return
+
+    def _end_data(self, cdata: bool = False):
+        if not self._data:
+            return
+        data = "".join(self._data)
+        self._data = []
+        _, hidden, preserve, container, _ = self._stack[-1]
+        if container and not cdata:
+            return
+        if not preserve and not data.strip(ASCII_SPACES):
+            data = "\n" if "\n" in data else " "
+        for element in self._anchors:
+            element.strings.append(data)
+        if not hidden:
+            data = data.strip()
+            if data:
+                self.strings.append(data)
+
+
+def extract(html: Union[str, bytes], tags: bool = False) -> Extracted:
+    """
+    Extracts the visible text segments, links and image sources of a page, see StreamExtractor.
+    :param html: bytes are decoded as BeautifulSoup would.
+    :param tags: also collect the <a> and <link> tags, None in the result if not.
+    """
+    if isinstance(html, bytes):
+        html = UnicodeDammit(html, is_html=True).unicode_markup
+    parser = StreamExtractor(tags)
+    parser.feed(html)
+    parser.close()
+    return Extracted(parser.strings, parser.links, parser.images, parser.html_lang, parser.tags if tags else None)
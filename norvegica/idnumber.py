@@ -0,0 +1,82 @@
+"""
+Finds Norwegian national identity numbers (fødselsnummer) in text, a sign of personal data on a page.
+The candidates are found by a single regex scan, and the control digits and birth dates of all of them are checked at
+once with NumPy, instead of one match at a time as in misc/id_number.py. The rules are the same as its find_id_number,
+but a number must not be part of a longer number.
+Many pages can be checked together with find_batch.
+"""
+import datetime
+import re
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+PATTERN = re.compile(r"(?<![0-9])[0-9]{6} ?[0-9]{5}(?![0-9])")
+LENGTH = 11
+
+K1_COEFFICIENTS = np.array((3, 7, 6, 1, 8, 9, 4, 5, 2))
+K2_COEFFICIENTS = np.array((5, 4, 3, 2, 7, 6, 5, 4, 3, 2))
+# By month, where 0 is for the months that do not exist, and February is 28 days unless it is a leap year
+DAYS_IN_MONTH = np.array((0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31))
+
+
+def find(txt: str) -> List[str]:
+    """
+    Finds the valid identity numbers in a text, without the space some are written with.
+    """
+    return find_batch([txt])[0]
+
+
+def find_batch(texts: Iterable[str], today: Optional[datetime.date] = None) -> List[List[str]]:
+    """
+    Finds the valid identity numbers in each of many texts, checking the candidates of all of them together.
+    :param today: birth dates after this are not valid, defaults to today.
+    :return: a list of the numbers found for each text.
+    """
+    found = [[number.replace(" ", "") for number in PATTERN.findall(txt)] for txt in texts]
+    numbers = [number for page in found for number in page]
+    ok = valid(to_digits(numbers), today).tolist()
+
+    results, i = [], 0
+    for page in found:
+        results.append([number for number, keep in zip(page, ok[i:i + len(page)]) if keep])
+        i += len(page)
+    return results
+
+
+def to_digits(numbers: List[str]) -> np.ndarray:
+    """
+    :return: the digits of 11 digit numbers, one row per number.
+    """
+    digits = np.frombuffer("".join(numbers).encode("ascii"), dtype=np.uint8).reshape(-1, LENGTH)
+    return digits.astype(np.int64) - ord("0")
+
+
+def valid(digits: np.ndarray, today: Optional[datetime.date] = None) -> np.ndarray:
+    """
+    Checks identity numbers given as rows of digits: both control digits, and that the birth date exists and is not
+    after today, in the century the individual number gives.
+    :return: whether each row is a valid number.
+    """
+    # A remainder of 0 gives the control digit 0, and 1 gives 10, which never matches a digit
+    k1 = -(digits[:, :9] @ K1_COEFFICIENTS) % 11
+    k2 = -(digits[:, :10] @ K2_COEFFICIENTS) % 11
+    ok = (k1 == digits[:, 9]) & (k2 == digits[:, 10])
+
+    day = digits[:, 0] * 10 + digits[:, 1]
+    month = digits[:, 2] * 10 + digits[:, 3]
+    year = digits[:, 4] * 10 + digits[:, 5]
+    individual = digits[:, 6] * 100 + digits[:, 7] * 10 + digits[:, 8]
+
+    century = np.select([(individual < 100) & (year < 40)
+                         | (individual >= 500) & ((year < 40) | (individual < 900) & (year < 55)),
+                         individual < 500,
+                         (individual < 800) & (year >= 55)],
+                        [2000, 1900, 1800], 0)
+    year += century
+    leap = (year % 4 == 0) & (year % 100 != 0) | (year % 400 == 0)
+    days = DAYS_IN_MONTH[np.where(month <= 12, month, 0)] + ((month == 2) & leap)
+    today = today or datetime.date.today()
+    born = year * 10000 + month * 100 + day
+    ok &= (century > 0) & (day >= 1) & (day <= days)
+    return ok & (born <= today.year * 10000 + today.month * 100 + today.day)
@@ -0,0 +1,169 @@
+"""
+In-process metrics for the norvegica pipeline: timing histograms per stage, page sizes, error counts and cache stats.
+Recorded by the server as well as by offline callers, and exposed in the Prometheus text format.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(8))  # 1 KiB to 16 MiB
+
+STAGE_SECONDS = "norvegica_stage_seconds"
+STAGE_ERRORS = "norvegica_stage_errors_total"
+PAGE_SIZE = "norvegica_page_size_chars"
+REQUEST_SECONDS = "norvegica_request_seconds"
+REQUESTS = "norvegica_requests_total"
+CASCADE_SKIPPED = "norvegica_cascade_skipped_total"
+SCAN_ABORTED = "norvegica_scan_aborted_total"
+CACHE_HITS = "norvegica_cache_hits"
+CACHE_MISSES = "norvegica_cache_misses"
+CACHE_SIZE = "norvegica_cache_size"
+
+
+class Registry:
+    """
+    Holds histograms, counters and gauges by name and labels.
+    Values can be drained in one process, e.g. a worker, and merged into another.
+    Gauges are kept per process, and the sum over the processes is reported.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}  # name -> (type, help, buckets)
+        # (name, labels) -> counter value, histogram bucket counts followed by the sum, or gauge values by process id
+        self._values = {}
+
+    def histogram(self, name: str, help_text: str, buckets: tuple):
+        self._metrics[name] = "histogram", help_text, buckets
+
+    def counter(self, name: str, help_text: str):
+        self._metrics[name] = "counter", help_text, None
+
+    def gauge(self, name: str, help_text: str):
+        self._metrics[name] = "gauge", help_text, None
+
+    def observe(self, name: str, value: float, **labels: str):
+        buckets = self._metrics[name][2]
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(buckets) + 1) + [0.0]
+            values[bisect_left(buckets, value)] += 1
+            values[-1] += value
+
+    def inc(self, name: str, amount: float = 1, **labels: str):
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels: str):
+        """
+        Sets a gauge to its current value in this process.
+        """
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            self._values.setdefault(key, {})[os.getpid()] = value
+
+    def drain(self) -> dict:
+        """
+        Takes all values recorded so far, and starts over from zero.
+        """
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values: dict):
+        """
+        Adds values drained from another registry.
+        """
+        with self._lock:
+            for key, value in values.items():
+                own = self._values.get(key)
+                if own is None:
+                    self._values[key] = _copy(value)
+                elif isinstance(own, dict):  # The latest values of the gauge in the other processes
+                    own.update(value)
+                elif isinstance(own, list):
+                    for i, v in enumerate(value):
+                        own[i] += v
+                else:
+                    self._values[key] = own + value
+
+    def to_prometheus(self) -> str:
+        """
+        Formats all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            values = {key: _copy(v) for key, v in self._values.items()}
+
+        lines = []
+        for name, (kind, help_text, buckets) in self._metrics.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(values.items()):
+                if metric != name:
+                    continue
+                if kind == "counter":
+                    lines.append(f"{name}{_labels(labels)} {value}")
+                    continue
+                if kind == "gauge":
+                    lines.append(f"{name}{_labels(labels)} {sum(value.values())}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float("inf"),), value):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _copy(value):
+    return list(value) if isinstance(value, list) else dict(value) if isinstance(value, dict) else value
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+registry.histogram(STAGE_SECONDS, "Time spent in each stage of the page analysis.", TIME_BUCKETS)
+registry.counter(STAGE_ERRORS, "Exceptions raised in each stage of the page analysis.")
+registry.histogram(PAGE_SIZE, "Size of the HTML of analyzed pages, in characters, or bytes if not decoded.", SIZE_BUCKETS)
+registry.histogram(REQUEST_SECONDS, "Time to handle each request to the server, by handler.", TIME_BUCKETS)
+registry.counter(REQUESTS, "Requests to the server, by handler and response status.")
+registry.counter(CASCADE_SKIPPED, "Stages skipped by WebPage.cascade, as the score was already decided.")
+registry.counter(SCAN_ABORTED, "Regex features that ran out of time in guarded scans, by feature.")
+registry.gauge(CACHE_HITS, "Lookups found in each cache, over all processes.")
+registry.gauge(CACHE_MISSES, "Lookups not found in each cache, over all processes.")
+registry.gauge(CACHE_SIZE, "Entries in each cache, over all processes.")
+
+observe = registry.observe
+inc = registry.inc
+set_gauge = registry.set
+
+
+@contextmanager
+def timed(stage: str):
+    """
+    Records the time spent in a block as a stage, and counts the exceptions raised from it.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        registry.inc(STAGE_ERRORS, stage=stage)
+        raise
+    finally:
+        registry.observe(STAGE_SECONDS, time.perf_counter() - start, stage=stage)
@@ -1,27 +1,139 @@
+"""
+The regular expressions used to find Norwegian features.
+The patterns built from res/expressions.json are only compiled when first used, or by load().
+"""
 import json
 import re
-
-expressions = json.load(open("res/expressions.json"))
+import threading
 
 ensure_start = r"((?<=\W)|(?<=^))"  # Split up because lookbehind requires fixed width
 ensure_end = r"(?=\W|$)"
 
 # Patterns
-pattern_names = re.compile(f"{ensure_start}"
-                           f"(({expressions['boy_names']}|{expressions['girl_names']})"
-                           f" ({expressions['surnames']})){ensure_end}")
-pattern_postal = re.compile(expressions["postal"], re.IGNORECASE)
-pattern_phone = re.compile(expressions["phone"])  # eg. "+47 51 99 00 00"
-pattern_norway = re.compile(f"{ensure_start}({expressions['norway_names']}){ensure_end}", re.IGNORECASE)
-pattern_counties = re.compile(f"{ensure_start}({expressions['counties']}){ensure_end}", re.IGNORECASE)
-pattern_kroner = re.compile(f"{expressions['kroner']}{ensure_end}", re.IGNORECASE)
-pattern_email = re.compile(expressions["email"])  # https://emailregex.com/
+pattern_postal = re.compile(r"(\d{4}),? ")  # Candidate postal code, the city is checked against postal_codes
 
 pattern_kr_dom = re.compile("se|dk|is|fo|gl", re.IGNORECASE)  # Domains of countries that use kr
 pattern_kr_lan = re.compile("sv|da|is|fo|kl", re.IGNORECASE)  # Language codes of countries that use kr
 pattern_no_html_lang = re.compile("^(no(?!ne)|nb|nn|nno|nob|nor)|bokmaal|nynorsk|NO$",
                                   re.IGNORECASE)  # Norwegian HTML lang names
 
-# All country code top level domains
-pattern_cctld = re.compile(expressions["cctld"])
+pattern_alternate = re.compile("alternat(e|ive)")  # rel values for alternate versions of a page
+
+# Characters that re.IGNORECASE matches to the letters we look up, but str.lower() does not
+case_fold = str.maketrans({"\u0130": "i", "\u0131": "i", "\u017f": "s"})
+
+# Names that are built from res/expressions.json on first access
+LAZY = {"expressions", "pattern_names", "pattern_phone", "pattern_norway", "pattern_counties", "pattern_kroner",
+        "pattern_email", "pattern_norway_full", "pattern_norway_link", "postal_codes", "first_names",
+        "first_name_initials", "norway_prefixes", "county_prefixes", "pattern_norway_prefix",
+        "pattern_counties_prefix", "pattern_scan", "pattern_cctld"}
+
+_lock = threading.Lock()
+_loaded = False
+
+
+def __getattr__(name: str):
+    if name in LAZY:
+        load()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def load():
+    """
+    Reads res/expressions.json and compiles the patterns that depend on it, if not already done.
+    """
+    global _loaded
+    with _lock:
+        if not _loaded:
+            globals().update(_build())
+            _loaded = True
+
+
+def is_loaded() -> bool:
+    return _loaded
+
+
+def literal_prefixes(alternation: str, length: int = 3) -> set:
+    """
+    Gives the distinct lower case literal prefixes of an alternation's branches.
+    One of them is found wherever one of the branches may match.
+    """
+    return {re.match(r"[^.?*+\\()\[\]{}|^$]{0,%d}" % length, alt)[0].lower() for alt in alternation.split("|")}
+
+
+def trie_regex(words) -> str:
+    """
+    Builds a regex matching any of the words, nested by common prefixes.
+    Unlike a flat alternation, the engine only follows branches that share the characters seen so far.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}  # End of word
+
+    def build(node: dict) -> str:
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        regex = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            regex = (regex if len(branches) == 1 and len(branches[0]) == 1 else f"(?:{regex})") + "?"
+        return regex
+
+    return build(trie)
+
+
+def _build() -> dict:
+    expressions = json.load(open("res/expressions.json"))
+
+    pattern_names = re.compile(f"{ensure_start}"
+                               f"(({expressions['boy_names']}|{expressions['girl_names']})"
+                               f" ({expressions['surnames']})){ensure_end}")
+    pattern_phone = re.compile(expressions["phone"])  # eg. "+47 51 99 00 00"
+    pattern_norway = re.compile(f"{ensure_start}({expressions['norway_names']}){ensure_end}", re.IGNORECASE)
+    pattern_counties = re.compile(f"{ensure_start}({expressions['counties']}){ensure_end}", re.IGNORECASE)
+    pattern_kroner = re.compile(f"{expressions['kroner']}{ensure_end}", re.IGNORECASE)
+    pattern_email = re.compile(expressions["email"])  # https://emailregex.com/
+
+    # Used to place <a> and <link> tags in a scheme
+    pattern_norway_full = re.compile(f"^(\\W*({expressions['norway_names']}|no|bokmål|nynorsk))+\\W*$",
+                                     re.IGNORECASE)  # Text with only Norway names, with repetitions
+    pattern_norway_link = re.compile(f"{expressions['norway_names']}|bokmål|nynorsk")  # Norway names in URLs
+
+    # Postal code -> lower case city, replaces matching the huge alternation in expressions["postal"]
+    postal_codes = {code: city.lower() for code, city in expressions["postal_codes"].items()}
+
+    # Used by the single pass scanner to find the tokens worth dispatching to the patterns above
+    first_names = set(expressions["boy_names"].split("|")) | set(expressions["girl_names"].split("|"))
+    first_name_initials = "".join(sorted({n[0] for n in first_names}))
+    norway_prefixes = literal_prefixes(expressions["norway_names"])
+    county_prefixes = literal_prefixes(expressions["counties"])
+    pattern_norway_prefix = re.compile(trie_regex(norway_prefixes), re.IGNORECASE)
+    pattern_counties_prefix = re.compile(trie_regex(county_prefixes), re.IGNORECASE)
+    pattern_scan = re.compile(
+        # Digit runs that may start a phone number ("0047" or "47") or postal code, or follow a currency.
+        # The first digit is matched before the lookarounds, which is much faster than checking them everywhere
+        r"\d(?<!\d\d)(?:(?<=0)(?=047)|(?<=4)(?=7)|(?=\d{3,}[, ])"
+        r"|(?i:(?<=kr\d)|(?<=nok\d)|(?<=kroner\d)|(?<=kr \d)|(?<=nok \d)|(?<=kroner \d)))\d*"
+        r"|@"  # Email
+        # Non-digit word runs that may be a first name followed by a space, Norway, a county, or a currency
+        r"|(?<![^\W\d])(?="
+        f"[{first_name_initials}][^\\W\\d]* "
+        f"|(?i:{trie_regex(norway_prefixes | county_prefixes | {'kr', 'nok'})})"
+        r")[^\W\d]+"
+    )
+
+    # All country code top level domains
+    pattern_cctld = re.compile(expressions["cctld"])
 
+    return dict(expressions=expressions, pattern_names=pattern_names, pattern_phone=pattern_phone,
+                pattern_norway=pattern_norway, pattern_counties=pattern_counties, pattern_kroner=pattern_kroner,
+                pattern_email=pattern_email, pattern_norway_full=pattern_norway_full,
+                pattern_norway_link=pattern_norway_link, postal_codes=postal_codes, first_names=first_names,
+                first_name_initials=first_name_initials, norway_prefixes=norway_prefixes,
+                county_prefixes=county_prefixes, pattern_norway_prefix=pattern_norway_prefix,
+                pattern_counties_prefix=pattern_counties_prefix, pattern_scan=pattern_scan,
+                pattern_cctld=pattern_cctld)
@@ -0,0 +1,150 @@
+"""
+Checks which candidates for a Norwegian version of a page actually exist, concurrently and with bounds.
+"""
+import asyncio
+from itertools import groupby
+from typing import Optional
+from weakref import WeakValueDictionary
+
+import aiohttp
+from yarl import URL
+
+import souper
+from cache import LRUCache
+
+OK_STATUSES = {200, 301, 302}
+
+
+class Prober:
+    """
+    Probes candidate URLs with HEAD requests. Results are cached per URL, also across pages.
+    """
+
+    def __init__(self, per_page: int = 8, per_host: int = 2, timeout: float = 5.0, cache_size: int = 10000,
+                 cache_ttl: float = 3600, session: Optional[aiohttp.ClientSession] = None, max_candidates: int = 16,
+                 deadline: float = 15.0, error_ttl: float = 60):
+        """
+        :param per_page: maximum number of candidates of one page probed at the same time.
+        :param per_host: maximum number of probes to one host at the same time, over all pages.
+        :param timeout: seconds before a probe is given up.
+        :param cache_size: number of probed URLs to remember.
+        :param cache_ttl: seconds to remember a probed URL.
+        :param session: session to probe with, defaults to the shared pooled session.
+        :param max_candidates: maximum number of candidates of one page probed, the best ones.
+        :param deadline: seconds before the probes of one page are given up, and no version is selected.
+        :param error_ttl: seconds to remember a probe that failed without a client error status, e.g. a timeout,
+                          which may well succeed later.
+        """
+        self.per_page = per_page
+        self.per_host = per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_candidates = max_candidates
+        self.deadline = deadline
+        self.error_ttl = error_ttl
+        self.cache = LRUCache(cache_size, ttl=cache_ttl)  # url -> (final url, ip), or False if it failed
+        self.session = session
+        self._host_limits = WeakValueDictionary()  # Kept while a probe to the host holds it
+
+    async def check(self, url: str) -> Optional[tuple]:
+        """
+        Checks whether a URL exists.
+        :return: the URL after redirects and its IP, or None if it does not respond with OK or a redirect.
+        """
+        found = self.cache.get(url)
+        if found is not None:
+            return found or None
+
+        try:
+            host = URL(url).host
+            limit = self._host_limits.get(host)
+            if limit is None:
+                limit = self._host_limits[host] = asyncio.Semaphore(self.per_host)
+            async with limit:
+                status, found = await self._request(url)
+            ttl = None if found or 400 <= status < 500 else self.error_ttl
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            found, ttl = None, self.error_ttl
+
+        self.cache.put(url, found or False, ttl)
+        return found
+
+    async def _request(self, url: str) -> tuple:
+        session = self.session or souper.get_session()
+        async with session.head(url, allow_redirects=True, timeout=self.timeout) as resp:
+            if resp.status in (405, 501):  # HEAD not supported, the body is not read
+                async with session.get(url, timeout=self.timeout) as get_resp:
+                    return await self._found(get_resp)
+            return await self._found(resp)
+
+    @staticmethod
+    async def _found(resp: aiohttp.ClientResponse) -> tuple:
+        """
+        :return: the status, and the URL after redirects and its IP if it is OK or a redirect, else None.
+        """
+        if resp.status not in OK_STATUSES:
+            return resp.status, None
+        return resp.status, (str(resp.url), await souper.get_ip_async(resp))
+
+    async def norwegian_version(self, candidates: list, original_url: str, redirect_url: str,
+                                ip: Optional[str]) -> dict:
+        """
+        Selects the best candidate for a Norwegian version that actually exists.
+        The best max_candidates candidates are probed concurrently, but taken in order, so a better candidate is always
+        preferred. The remaining probes are cancelled as soon as one is selected, or when the deadline is reached.
+
+        :param candidates: (scheme, url) from WebPage.norwegian_candidates.
+        :param ip: the IP of the page, to compare to the IP of the Norwegian version.
+        :return: a dict containing the scheme in which it was discovered,
+                 the number of matching IPv4 bytes (-1 if the deadline was reached), and the URL of the page.
+        """
+        try:
+            return await asyncio.wait_for(self._select(candidates, original_url, redirect_url, ip), self.deadline)
+        except asyncio.TimeoutError:
+            return {"url": None, "scheme": souper.NO_MATCH, "ip_match": -1}
+
+    async def _select(self, candidates: list, original_url: str, redirect_url: str, ip: Optional[str]) -> dict:
+        page_limit = asyncio.Semaphore(self.per_page)
+
+        async def bounded_check(u: str):
+            async with page_limit:
+                return await self.check(u)
+
+        # Started in order, so the best candidates get the first slots
+        tasks = {}
+        for _, url in candidates:
+            if len(tasks) >= self.max_candidates:
+                break
+            if url not in tasks and url != original_url and url != redirect_url:
+                tasks[url] = asyncio.ensure_future(bounded_check(url))
+
+        try:
+            for scheme, group in groupby(candidates, key=lambda c: c[0].lstrip("/")):
+                queue = None  # Queue is for matches where the url is the same as the original result
+                for sch, url in group:
+                    if url == original_url or url == redirect_url:
+                        queue = sch
+                        continue
+                    found = await tasks[url] if url in tasks else None  # Worse than the candidates probed
+                    if found:
+                        new_url, new_ip = found
+                        return {"url": new_url, "scheme": sch, "ip_match": ip_match(ip, new_ip)}
+                if queue:
+                    return {"url": redirect_url, "scheme": queue, "ip_match": 4}
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+        return {"url": None, "scheme": souper.NO_MATCH, "ip_match": 0}
+
+
+def ip_match(ip: Optional[str], other: Optional[str]) -> int:
+    """
+    Counts the matching leading bytes of two IPv4 addresses.
+    """
+    i = 0
+    for o, n in zip((ip or "").split("."), (other or "").split(".")):
+        if o == n and o:
+            i += 1
+        else:
+            break
+    return i
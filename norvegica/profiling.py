@@ -0,0 +1,50 @@
+"""
+Profiling of single analyses, to diagnose pathological pages.
+"""
+import cProfile
+import os
+import pstats
+import time
+from typing import Callable, Optional
+
+from cache import content_hash
+
+
+def profile_call(func: Callable, top: int = 25, dump_dir: Optional[str] = None, name: str = "") -> tuple:
+    """
+    Calls a function under cProfile.
+
+    :param func: the function to call, without arguments.
+    :param top: number of functions to report, by cumulative time.
+    :param dump_dir: directory to write the raw profile to, for e.g. snakeviz or pstats. Not written if None.
+    :param name: what is profiled, e.g. the URL, used in the name of the dumped file.
+    :return: the result of func, and a dict with the total time, the top functions and the dumped file.
+    """
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        result = func()
+    finally:
+        profiler.disable()
+    elapsed = time.perf_counter() - start
+
+    stats = pstats.Stats(profiler).sort_stats(pstats.SortKey.CUMULATIVE)
+    functions = []
+    for func_key in stats.fcn_list[:top]:
+        filename, line, function = func_key
+        _, calls, total_time, cumulative_time, _ = stats.stats[func_key]
+        functions.append({
+            "function": f"{os.path.basename(filename)}:{line}({function})",
+            "calls": calls,
+            "total_time": round(total_time, 6),
+            "cumulative_time": round(cumulative_time, 6),
+        })
+
+    path = None
+    if dump_dir:
+        os.makedirs(dump_dir, exist_ok=True)
+        path = os.path.join(dump_dir, f"{time.strftime('%Y%m%dT%H%M%S')}-{content_hash(name)[:12]}.prof")
+        profiler.dump_stats(path)
+
+    return result, {"seconds": round(elapsed, 6), "functions": functions, "file": path}
@@ -1,9 +1,28 @@
-from urllib.error import URLError
+import time
 
-from aiohttp import web
+STARTED = time.perf_counter()  # Before the other imports, to include them in the startup time
+
+import asyncio
+import json
+import traceback
+from datetime import datetime
+from typing import Optional
+
+from aiohttp import web, ClientError, StreamReader
 from aiohttp.web_request import Request
 
-from souper import detect_language, get_text, get_domain
+try:
+    import orjson
+except ImportError:  # Optional, the standard json module is used instead
+    orjson = None
+
+import config
+import metrics
+import souper
+import worker
+from cache import CachedResult, ResultCache, content_hash
+from probe import Prober
+from souper import close_session
 from WebPage import WebPage
 
 routes = web.RouteTableDef()
@@ -15,27 +34,27 @@ async def handle_language_detection(request: Request):
 
     if "url" in data:
         try:
-            wp = WebPage.from_url(data["url"])
-            domain = get_domain(wp.redirect_url)
-            http_lang = wp.content_language
-            html = wp.raw_html
-            text = get_text(wp.raw_html)
+            wp = await WebPage.from_url_async(data["url"])
         except ValueError:
             return web.HTTPBadRequest(reason="Malformed url.")
-        except URLError:
+        except ClientError:
             return web.HTTPBadRequest(reason="Name or service not known.")
+        except asyncio.TimeoutError:
+            return web.HTTPGatewayTimeout(reason="Timed out fetching url.")
+        # The page is parsed for its text in the executor, as for the other services
+        resp = await worker.language_async(wp.fields)
     else:
         domain = data["domain"] if "domain" in data else None
         http_lang = data["http_lang"] if "http_lang" in data else None
         html = data["html"] if "html" in data else None
         text = data["text"] if "text" in data else None
 
-    if not html and not text:
-        return web.HTTPUnprocessableEntity(reason="Unable to make prediction, missing 'url', 'text' or 'html'")
+        if not html and not text:
+            return web.HTTPUnprocessableEntity(reason="Unable to make prediction, missing 'url', 'text' or 'html'")
 
-    resp = detect_language(html=html, txt=text, domain=domain, http_lang=http_lang)
+        resp = await worker.language_async(None, html, text, domain, http_lang)
 
-    return web.json_response(data=resp)
+    return json_response(resp)
 
 
 @routes.post("/url")
@@ -46,25 +65,277 @@ async def handle_url_check(request: Request):
         return web.HTTPUnprocessableEntity(reason="'url' field not present in request.")
 
     url = data["url"]
+    profile = wants_profile(request, data)
+    select = wants_fields(request, data)
     try:
-        wp = WebPage.from_url(url)
-        resp = wp.extra_info
+        if profile:  # Always analyzed again, and not cached
+            wp = await WebPage.from_url_async(url)
+            resp = await worker.analyze_async(wp.fields, profile=True, prober=request.app["prober"], select=select)
+        else:
+            resp = await analyze_url(request.app["results"], request.app["prober"], url, select)
 
-        return web.json_response(data=resp)
+        return json_response(resp)
     except ValueError:
         return web.HTTPBadRequest(reason="Malformed url.")
-    except URLError:
+    except ClientError:
         return web.HTTPBadRequest(reason="Name or service not known.")
+    except asyncio.TimeoutError:
+        return web.HTTPGatewayTimeout(reason="Timed out fetching url.")
 
 
 @routes.post("/webpage")
 async def handle_webpage(request: Request):
     data = await request.post()
-    wp = WebPage(**data)
-    return web.json_response(wp.extra_info)
+    profile = wants_profile(request, data)
+    select = wants_fields(request, data)
+    fields = {k: v for k, v in data.items() if k not in ("profile", "fields")}
+    # Given pages may be archived, so the Norwegian version is not probed, see analyze_url
+    return json_response(await worker.analyze_async(fields, profile=profile, select=select))
+
+
+def wants_profile(request: Request, data) -> bool:
+    """
+    Whether a request asks to be profiled, with a "profile=1" form field or an "X-Norvegica-Profile: 1" header.
+    The result then has a "profile" with the hot functions, see profiling.profile_call.
+    """
+    requested = data.get("profile") == "1" or request.headers.get("X-Norvegica-Profile") == "1"
+    if requested and not config.PROFILING:
+        raise web.HTTPForbidden(reason="Profiling is disabled, see NORVEGICA_PROFILING.")
+    return requested
+
+
+def wants_fields(request: Request, data) -> Optional[list]:
+    """
+    The fields of extra_info a request asks for, comma separated in a "fields" form field or query parameter.
+    Only those are computed, see WebPage.info. All of them if not given.
+    """
+    requested = data.get("fields") or request.query.get("fields")
+    if not requested:
+        return None
+    select = [field.strip() for field in requested.split(",") if field.strip()]
+    unknown = set(select).difference(WebPage.FIELDS)
+    if unknown:
+        raise web.HTTPBadRequest(reason=f"Unknown fields {', '.join(sorted(unknown))}.")
+    return select
+
+
+def dumps(data) -> bytes:
+    """
+    Encodes JSON with orjson if installed, which is much faster for large results.
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
+
+
+def json_response(data, status: int = 200) -> web.Response:
+    """
+    Same as web.json_response, but encoded by dumps, and compressed if the client accepts it.
+    """
+    response = web.Response(body=dumps(data), status=status, content_type="application/json")
+    response.enable_compression()
+    return response
+
+
+@routes.post("/batch")
+async def handle_batch(request: Request):
+    """
+    Analyzes newline-delimited JSON, and streams back one line per page as soon as it is done.
+    Each line is either an object of WebPage fields, an object with only a "url" to fetch, or a string of raw HTML.
+    Results are {"line": n, "result": extra_info} or {"line": n, "error": reason}, where n counts non-empty lines.
+    A "fields" query parameter selects the fields of every result, as for /url.
+    """
+    select = wants_fields(request, {})
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+
+    # Lines are only read while there is budget, so a large batch is never held in memory
+    budget = asyncio.Semaphore(config.BATCH_WORKERS)
+    write_lock = asyncio.Lock()
+    tasks = set()
+
+    async def process(n: int, line: bytes):
+        try:
+            out = {"line": n, "result": await analyze_line(request, line, select)}
+        except Exception as e:
+            out = {"line": n, "error": f"{type(e).__name__}: {e}"}
+        finally:
+            budget.release()
+        async with write_lock:
+            await response.write(dumps(out) + b"\n")
+
+    n = 0
+    async for line in iter_lines(request.content):
+        if not line.strip():
+            continue
+        await budget.acquire()
+        task = asyncio.ensure_future(process(n, line))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        n += 1
+
+    await asyncio.gather(*tasks)
+    await response.write_eof()
+    return response
+
+
+async def analyze_line(request: Request, line: bytes, select: Optional[list] = None) -> dict:
+    """
+    Computes the extra_info of a /batch line without blocking the event loop.
+    """
+    fields = json.loads(line)
+    if isinstance(fields, str):
+        fields = dict(orig_url="", redirect_url="", raw_html=fields, ip=None)
+    elif fields.keys() == {"url"}:
+        return await analyze_url(request.app["results"], request.app["prober"], fields["url"], select)
+
+    return await worker.analyze_async(fields, select=select)
+
+
+async def analyze_url(results: ResultCache, prober: Optional[Prober], url: str,
+                      select: Optional[list] = None) -> dict:
+    """
+    Fetches a URL and computes its extra_info, reusing the previous result if the page has not changed.
+    Only live pages like these have their Norwegian version probed, given pages are analyzed without requests.
+    A cached result is revalidated with its ETag/Last-Modified, or by the content hash if the site sends neither.
+    Only complete results are cached, a selection of fields is taken from the cached result when there is one.
+    """
+    entry = results.get(url)
+    if entry is None:
+        wp = await WebPage.from_url_async(url)
+    else:
+        wp = await WebPage.from_url_async(url, etag=entry.etag, last_modified=entry.last_modified)
+        if wp is None:  # Not modified
+            return project(dict(entry.result, timestamp=int(datetime.utcnow().timestamp())), select)
+
+    # Everything the analysis depends on, apart from the time it was fetched and the validators
+    h = content_hash(wp.source, wp.charset, wp.original_url, wp.redirect_url, wp.ip, wp.geo_loc, wp.content_language)
+    if entry is not None and entry.content_hash == h:
+        result = dict(entry.result, timestamp=wp.timestamp, last_modified=wp.last_modified, etag=wp.etag)
+    else:
+        result = await worker.analyze_async(wp.fields, prober=prober, select=select)
+        if select is not None:
+            return result
+
+    results.put(url, CachedResult(wp.etag, wp.last_modified, h, result))
+    return project(result, select)
+
+
+def project(result: dict, select: Optional[list]) -> dict:
+    """
+    Keeps only the selected fields of a result, in the same order.
+    """
+    if select is None:
+        return result
+    return {k: v for k, v in result.items() if k in select}
+
+
+async def iter_lines(stream: StreamReader):
+    """
+    Yields the lines of a request body. Unlike iterating the stream directly, lines may be of any length.
+    """
+    buffer = bytearray()
+    async for chunk in stream.iter_any():
+        buffer += chunk
+        start = 0
+        while (end := buffer.find(b"\n", start)) >= 0:
+            yield bytes(buffer[start:end])
+            start = end + 1
+        del buffer[:start]
+    if buffer:
+        yield bytes(buffer)
+
+
+@routes.get("/metrics")
+async def handle_metrics(request: Request):
+    """
+    Stage timings, page sizes, errors, request counts and cache stats, in the Prometheus text format.
+    The cache stats of worker processes are those of the last page they analyzed.
+    """
+    souper.record_cache_stats()
+    return web.Response(text=metrics.registry.to_prometheus(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+@routes.get("/healthz")
+async def handle_healthz(request: Request):
+    """
+    Liveness probe, the server is up as soon as it accepts connections.
+    """
+    return web.json_response({"status": "ok"})
+
+
+@routes.get("/readyz")
+async def handle_readyz(request: Request):
+    """
+    Readiness probe, ready once the patterns, the GeoIP database and the workers are loaded.
+    """
+    task = request.app["warm_up"]
+    if not task.done():
+        return web.json_response({"ready": False}, status=503)
+    if task.cancelled() or task.exception():
+        return web.json_response({"ready": False, "error": "warm up failed"}, status=503)
+    return web.json_response({"ready": True, "startup_seconds": request.app["startup_seconds"]})
+
+
+async def warm_up(app: web.Application):
+    """
+    Loads everything needed to analyze pages in the background, while the server already answers probes.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(loop.run_in_executor(None, souper.warm_up), worker.start())
+    except Exception:
+        traceback.print_exc()
+        raise
+    app["startup_seconds"] = round(time.perf_counter() - STARTED, 3)
+    print(f"Ready in {app['startup_seconds']} s", flush=True)
+
+
+async def on_startup(app: web.Application):
+    app["results"] = ResultCache(config.RESULT_CACHE_SIZE, config.RESULT_CACHE_PATH)
+    app["prober"] = Prober(config.PROBE_PER_PAGE, config.PROBE_PER_HOST, config.PROBE_TIMEOUT,
+                           max_candidates=config.PROBE_MAX_CANDIDATES, deadline=config.PROBE_DEADLINE) \
+        if config.PROBE else None
+    app["warm_up"] = asyncio.ensure_future(warm_up(app))
+
+
+async def on_cleanup(app: web.Application):
+    app["warm_up"].cancel()
+    await close_session()
+    worker.shutdown()
+    app["results"].close()
+
+
+@web.middleware
+async def metrics_middleware(request: Request, handler):
+    """
+    Records the time and response status of every request, by handler.
+    """
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        name = resource.canonical if resource else "unmatched"
+        metrics.observe(metrics.REQUEST_SECONDS, time.perf_counter() - start, handler=name)
+        metrics.inc(metrics.REQUESTS, handler=name, status=str(status))
+
 
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[metrics_middleware])
+    app.add_routes(routes)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
 
-app = web.Application()
-app.add_routes(routes)
 
-web.run_app(app)
+if __name__ == "__main__":
+    # Guarded, as worker processes import this module again
+    web.run_app(create_app())
@@ -1,14 +1,26 @@
+import asyncio
+import codecs
+import re
 import socket
-from collections import Counter
+import time
+from bisect import bisect_right
+from collections import Counter, namedtuple
+from itertools import accumulate
 from http.client import HTTPResponse
-from typing import Optional
+from typing import Optional, Union
 from urllib.parse import urlparse
 
+import aiohttp
 import pycld2
 from bs4 import BeautifulSoup, Tag, Comment
 from geoip2.database import Reader
 
-from patterns import *
+import config
+import htmlstream
+import idnumber
+import metrics
+import patterns
+from cache import LRUCache, content_hash
 
 NO_MATCH = "no_match"
 REPLACE = "replace"
@@ -22,53 +34,439 @@ ALREADY_NO = "already_no"
 SCHEMES = ALREADY_NO, HREF_HREFLANG_REL, HREF_NORWAY_FULL, HREF_HREFLANG, HREF_LANG, \
           REPLACE, HREF_NORWAY_PARTIAL, HREF_NORWAY_LINK, NO_MATCH  # Ordered from best to worst
 
-reader = Reader('res/GeoIP2-Country.mmdb')
+_reader: Optional[Reader] = None  # Opened on first use, see get_reader
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
                   "Chrome/70.0.3538.77 Safari/537.36"}
 
+# Connection pool settings for the shared aiohttp session
+POOL_LIMIT = 100
+POOL_LIMIT_PER_HOST = 8
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+FETCH_TIMEOUT = 30
+
+_session: Optional[aiohttp.ClientSession] = None
+
+# Lookup caches, shared by all pages of the process
+IP_CACHE_SIZE = 10000
+GEO_CACHE_SIZE = 10000
+GEO_CACHE_TTL = 24 * 3600  # The GeoIP database itself is only updated weekly
+GEO_PREFIX_LEN = 24  # Addresses in a network at least this wide share a cache entry
+
+_ip_cache = LRUCache(IP_CACHE_SIZE, ttl=DNS_CACHE_TTL)
+_geo_cache = LRUCache(GEO_CACHE_SIZE, ttl=GEO_CACHE_TTL)
+
+# Results for identical content, e.g. mirrors and unchanged pages, by a hash of the content
+MEMO_SIZE = 1024
+MEMO_MAX_CHARS = 32 * 2 ** 20  # Bounds the memory of the parsed pages, mostly their text
+
+_parse_memo = LRUCache(MEMO_SIZE, max_weight=MEMO_MAX_CHARS,
+                       weigh=lambda p: len(p.text or "") + sum(len(link or "") for link in p.links or ()))
+_language_memo = LRUCache(MEMO_SIZE)
+_features_memo = LRUCache(MEMO_SIZE)
+
+# Guarded scans of the regex features, see scan_features_guarded
+SCAN_WINDOW = 10000  # Characters of each window sampled from long texts
+MAX_MATCH_CHARS = 320  # No feature is longer, so matches are not tried further than this from where they start
+DEADLINE_EVERY = 64  # Candidates matched between checks of the time budget
+
+# Downloads are read in chunks, and only decoded when the text is needed
+CHUNK_SIZE = 64 * 1024
+SNIFF_BYTES = 4096  # Where to look for <meta charset>, more than the 1024 bytes the HTML standard requires
+DEFAULT_CHARSET = "utf-8"
+# Labels that browsers decode as windows-1252, see https://encoding.spec.whatwg.org/
+WEB_CHARSETS = {"iso8859-1": "cp1252", "ascii": "cp1252"}
+BOMS = ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+
+pattern_header_charset = re.compile(r"charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+pattern_meta_charset = re.compile(rb"<meta[^>]+charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+
+# Weights of norvegica_score, also used to rescore stored features, see rescore.py
+SCORE_WEIGHTS = {
+    "language": 2.0,  # Maximum for the Norwegian score from cld2
+    # Regex feature: the count used, the count giving half the maximum, and the maximum
+    "postal": ("unique", 1, 2.0),
+    "phone": ("unique", 1, 1.3),
+    "county": ("total", 1, 1.1),
+    "name": ("unique", 1, 0.5),
+    "norway": ("total", 2, 1.1),
+    "email": ("unique", 1, 1.2),
+    "kroner": ("total", 1, 0.1),
+    "kr_country": 0.1,  # Multiplies the maximum of kroner and names for pages that may be from other kr countries
+    "geo": 0.25,  # For a Norwegian IP
+    "content_language": 0.25,  # For a Norwegian Content-Language header
+    "html_lang": 0.25,  # For a Norwegian <html> lang
+    "midpoint": 1.0,  # Total giving a score of 0.5
+}
+SCORE_FEATURES = ("postal", "phone", "county", "name", "norway", "email", "kroner")  # In the order they are added
+KR_FEATURES = ("name", "kroner")  # Shared with other countries that use kr
+
+# Everything extracted from a single parse of a page
+ParsedHtml = namedtuple("ParsedHtml", ["text", "links", "html_lang", "tag_links"])
+
 
 # Methods
 def has_name(txt: str) -> Counter:
-    names = pattern_names.findall(txt)
+    names = patterns.pattern_names.findall(txt)
     return Counter(n[1] for n in names)
 
 
 def has_postal(txt: str) -> Counter:
-    postals = pattern_postal.findall(txt)
-    return Counter(postals)
+    return Counter(find_postal(txt))
+
+
+def find_postal(txt: str):
+    """
+    Finds postal codes followed by their city, e.g. "8624 Mo i Rana".
+    Cheap candidates are looked up in a dict of valid codes, giving the same non-overlapping,
+    case-insensitive matches as an alternation of every "code,? city" pair.
+    """
+    pos = 0
+    while True:
+        m = patterns.pattern_postal.search(txt, pos)
+        if not m:
+            return
+        end = _postal_end(txt, m)
+        if end:
+            yield txt[m.start():end]
+            pos = end
+        else:
+            pos = m.start() + 1
+
+
+def _postal_end(txt: str, m: re.Match) -> Optional[int]:
+    """
+    Gives the end of the city following a postal code candidate, or None if it is not a valid pair.
+    """
+    city = patterns.postal_codes.get(m[1])
+    if city:
+        end = m.end() + len(city)
+        if txt[m.end():end].translate(patterns.case_fold).lower() == city:
+            return end
+    return None
 
 
 def has_phone_number(txt: str) -> Counter:
-    phones = pattern_phone.findall(txt)
+    phones = patterns.pattern_phone.findall(txt)
     return Counter(p[1].replace(" ", "") for p in phones)
 
 
 def has_norway(txt: str) -> Counter:
-    nor = pattern_norway.findall(txt)
+    nor = patterns.pattern_norway.findall(txt)
     return Counter(n[1] for n in nor)
 
 
 def has_county(txt: str) -> Counter:
-    cou = pattern_counties.findall(txt)
+    cou = patterns.pattern_counties.findall(txt)
     return Counter(c[1] for c in cou)
 
 
 def has_kroner(txt: str) -> Counter:
-    kr = pattern_kroner.findall(txt)
+    kr = patterns.pattern_kroner.findall(txt)
     return Counter(k[0] for k in kr)
 
 
 def has_email(txt: str) -> Counter:
-    mail = pattern_email.findall(txt)
+    mail = patterns.pattern_email.findall(txt)
     return Counter(m for m in mail if m.endswith(".no"))
 
 
+def has_id_number(txt: str) -> Counter:
+    """
+    Counts the national identity numbers (fødselsnummer) with valid control digits and birth date, see idnumber.
+    This is personal data, and not part of the score.
+    """
+    return Counter(idnumber.find(txt))
+
+
+# Characters that can be part of the local part of an email, before the @
+_EMAIL_LOCAL = frozenset("abcdefghijklmnopqrstuvwxyz0123456789!#$%&'*+/=?^_`{|}~-.")
+_EMAIL_QUOTED = frozenset(chr(c) for c in range(1, 128)) - {"\n", "\r"}
+_KRONER_SUFFIXES = frozenset(("kr", "kroner", "nok"))
+# Detector, name of its pattern in patterns, and the group to count
+_SCAN_PATTERNS = (("postal", "pattern_postal", 0), ("phone", "pattern_phone", 2), ("county", "pattern_counties", 2),
+                  ("name", "pattern_names", 2), ("norway", "pattern_norway", 2), ("kroner", "pattern_kroner", 1),
+                  ("email", "pattern_email", 0))
+
+
+def scan_features(txt: str, single_pass: bool = True) -> dict:
+    """
+    Finds all the regex features of a text.
+
+    :param txt: the text to scan.
+    :param single_pass: tokenize the text once, and only try each pattern at the candidate positions
+                        dispatched to it. If False, every has_* function scans the whole text.
+    :return: a dict of Counters, with the same content as the has_* functions.
+    """
+    if not single_pass:
+        return {"postal": has_postal(txt), "phone": has_phone_number(txt), "county": has_county(txt),
+                "name": has_name(txt), "norway": has_norway(txt), "kroner": has_kroner(txt),
+                "email": has_email(txt), "id_number": has_id_number(txt)}
+
+    with metrics.timed("scan"):
+        candidates = _scan_candidates(txt)
+
+    counters = {}
+    for key, name, group in _SCAN_PATTERNS:
+        with metrics.timed(f"regex_{key}"):
+            counters[key], _ = _match_candidates(txt, key, getattr(patterns, name), group, candidates[key])
+    # Not dispatched from the tokens, the candidates in the whole text are checked together instead
+    with metrics.timed("regex_id_number"):
+        counters["id_number"] = has_id_number(txt)
+
+    return counters
+
+
+def scan_features_guarded(txt: str, max_chars: Optional[int] = None, budget: Optional[float] = None) -> tuple:
+    """
+    Same as scan_features, but in bounded time whatever the text, for the pathological pages that would otherwise
+    keep a worker busy for minutes. Texts longer than max_chars are sampled, see sample_text, no match is tried further
+    than MAX_MATCH_CHARS, and each feature stops matching once its time budget is spent.
+
+    :param max_chars: characters to scan at most, defaults to config.SCAN_MAX_CHARS.
+    :param budget: seconds each feature may take, defaults to config.SCAN_BUDGET.
+    :return: a dict of Counters as from scan_features, but only of the part of the text that was scanned,
+             and a dict of the share of the text that was scanned for each feature.
+    """
+    max_chars = max_chars or config.SCAN_MAX_CHARS
+    budget = config.SCAN_BUDGET if budget is None else budget
+    sample = sample_text(txt, max_chars)
+    sampled = len(sample) / len(txt) if len(sample) < len(txt) else 1.0
+
+    with metrics.timed("scan"):
+        candidates = _scan_candidates(sample, MAX_MATCH_CHARS)
+
+    counters, ratios = {}, {}
+    for key, name, group in _SCAN_PATTERNS:
+        with metrics.timed(f"regex_{key}"):
+            counters[key], scanned = _match_candidates(sample, key, getattr(patterns, name), group, candidates[key],
+                                                       time.perf_counter() + budget, MAX_MATCH_CHARS)
+        if scanned < len(sample):
+            metrics.inc(metrics.SCAN_ABORTED, feature=key)
+        ratios[key] = sampled * scanned / len(sample) if sample else 1.0
+    with metrics.timed("regex_id_number"):
+        counters["id_number"] = has_id_number(sample)
+    ratios["id_number"] = sampled
+
+    return counters, ratios
+
+
+def sample_text(txt: str, max_chars: int, window: int = SCAN_WINDOW) -> str:
+    """
+    Takes evenly spaced windows of a text, about max_chars in total, cut at the tabs between its segments
+    unless a segment is longer than the window.
+    :return: the windows joined by tabs, or the whole text if it is no longer than max_chars.
+    """
+    if len(txt) <= max_chars:
+        return txt
+    count = max(1, max_chars // window)
+    stride = len(txt) / count
+    windows = []
+    for i in range(count):
+        start = int(i * stride)
+        if start:
+            tab = txt.find("\t", start, start + window)
+            start = tab + 1 if tab >= 0 else start
+        end = txt.find("\t", start + window, start + 2 * window)
+        windows.append(txt[start:end if end >= 0 else start + window])
+    return "\t".join(windows)
+
+
+def _scan_candidates(txt: str, max_match: Optional[int] = None) -> dict:
+    """
+    Tokenizes the text once, and finds the positions where each pattern of scan_features may match.
+    :param max_match: characters a match may span at most, to only look that far back for where it may start.
+    """
+    reach = max_match or len(txt)
+    quoted_floor = 0  # Quoted local parts can contain @, so the candidates before this were already found
+    case_fold, first_names = patterns.case_fold, patterns.first_names
+    pattern_norway_prefix, pattern_counties_prefix = patterns.pattern_norway_prefix, patterns.pattern_counties_prefix
+    candidates = {k: [] for k in ("postal", "phone", "county", "name", "norway", "kroner", "email")}
+
+    for tok in patterns.pattern_scan.finditer(txt):
+        start, end = tok.span()
+        first = txt[start]
+
+        if first == "@":
+            # Dot-atom local part
+            pos = start
+            while pos > start - reach and pos and txt[pos - 1] in _EMAIL_LOCAL:
+                pos -= 1
+            candidates["email"].extend(range(pos, start))
+            # Quoted local part
+            if start and txt[start - 1] == '"':
+                pos = start - 1
+                while pos > max(start - reach, quoted_floor) and txt[pos - 1] in _EMAIL_QUOTED:
+                    pos -= 1
+                candidates["email"].extend(i for i in range(pos, start - 1) if txt[i] == '"')
+                quoted_floor = start - 1
+
+        elif first.isdecimal():
+            # Code followed by ",? "
+            if end - start >= 4 and txt[end:end + 1] in (",", " "):
+                candidates["postal"].append(end - 4)
+            # From the non-digit before "(+47", "+47", "0047" or "47"
+            if txt.startswith("47", start) or txt.startswith("0047", start):
+                candidates["phone"].extend(range(max(start - 3, 0), start if start else 1))
+            # A currency followed by an amount
+            currency_end = start - 1 if txt[start - 1:start] == " " else start
+            for length in (2, 3, 6):
+                if currency_end >= length \
+                        and txt[currency_end - length:currency_end].translate(case_fold).lower() in _KRONER_SUFFIXES:
+                    candidates["kroner"].append(currency_end - length)
+
+        else:
+            # Patterns with ensure_start can only match at the start of a word
+            if start == 0 or not txt[start - 1].isdecimal():
+                if pattern_norway_prefix.match(txt, start):
+                    candidates["norway"].append(start)
+                if pattern_counties_prefix.match(txt, start):
+                    candidates["county"].append(start)
+                if txt[end:end + 1] == " " and txt[start:end] in first_names:
+                    candidates["name"].append(start)
+
+            # An amount followed by a currency that starts a word
+            if txt[start:start + 2].translate(case_fold).lower() == "kr" \
+                    or txt[start:start + 3].translate(case_fold).lower() == "nok":
+                pos = start
+                while pos > start - reach and pos and (txt[pos - 1].isdecimal() or txt[pos - 1] in ".,- "):
+                    pos -= 1
+                candidates["kroner"].extend(i for i in range(pos, start) if txt[i].isdecimal())
+
+    return candidates
+
+
+def _match_candidates(txt: str, key: str, pattern: re.Pattern, group: int, positions: list,
+                      deadline: Optional[float] = None, max_match: Optional[int] = None) -> tuple:
+    """
+    Matches a pattern at candidate positions, and counts the results like the corresponding has_* function.
+
+    :param deadline: a time.perf_counter() to stop matching at.
+    :param max_match: characters a match may span at most.
+    :return: the Counter, and the position in the text it covers, which is the end unless the deadline was reached.
+    """
+    counter = Counter()
+    last_end = 0
+    # Leftmost non-overlapping matches, like findall
+    for i, pos in enumerate(sorted(set(positions))):
+        if pos < last_end:
+            continue
+        if deadline is not None and i % DEADLINE_EVERY == 0 and time.perf_counter() > deadline:
+            return counter, pos
+        m = pattern.match(txt, pos, pos + max_match) if max_match else pattern.match(txt, pos)
+        if key == "postal":
+            postal_end = _postal_end(txt, m) if m else None
+            if postal_end:
+                counter[txt[pos:postal_end]] += 1
+                last_end = postal_end
+        elif m:
+            found = m[group] or ""
+            if key == "phone":
+                found = found.replace(" ", "")
+            if key != "email" or found.endswith(".no"):
+                counter[found] += 1
+            last_end = m.end()
+    return counter, len(txt)
+
+
+class PageReader:
+    """
+    Reads a page as it is downloaded, and stops at a maximum size.
+    The bytes are kept undecoded, see decode_page, and the charset is sniffed from the start of the page.
+    """
+
+    def __init__(self, content_type: Optional[str] = None, max_bytes: Optional[int] = None):
+        """
+        :param content_type: the Content-Type header of the response.
+        :param max_bytes: bytes to read at most, defaults to config.MAX_PAGE_BYTES.
+        """
+        self.max_bytes = max_bytes or config.MAX_PAGE_BYTES
+        self.content_type = content_type
+        self.size = 0
+        self.truncated = False
+        self._parts = []
+        self._payload = None
+        self._charset = None
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        Adds the next chunk of the page.
+        :return: whether more should be read, False once max_bytes is reached.
+        """
+        if self.size + len(chunk) > self.max_bytes:
+            chunk = chunk[:self.max_bytes - self.size]
+            self.truncated = True
+        self.size += len(chunk)
+        self._parts.append(chunk)
+        return not self.truncated
+
+    def payload(self) -> bytes:
+        """
+        :return: the undecoded page.
+        """
+        if self._payload is None:
+            self._payload = b"".join(self._parts)
+            self._parts = [self._payload]
+        return self._payload
+
+    @property
+    def charset(self) -> str:
+        if self._charset is None:
+            self._charset = sniff_charset(self.payload()[:SNIFF_BYTES], self.content_type)
+        return self._charset
+
+
+def sniff_charset(head: bytes, content_type: Optional[str] = None) -> str:
+    """
+    Finds the charset of a page from a BOM, the Content-Type header or a <meta> tag, in that order, or else UTF-8.
+
+    :param head: the start of the page, the first SNIFF_BYTES are searched for a <meta> tag.
+    :param content_type: the Content-Type header of the response.
+    """
+    charset = next((name for bom, name in BOMS if head.startswith(bom)), None)
+    if not charset:
+        m = pattern_header_charset.search(content_type or "")
+        charset = m[1] if m else None
+    if not charset:
+        m = pattern_meta_charset.search(head, 0, SNIFF_BYTES)
+        charset = m[1].decode("ascii") if m else None
+    return normalize_charset(charset)
+
+
+def decode_page(payload, charset: str, truncated: bool = False) -> str:
+    """
+    Decodes a page, replacing invalid bytes.
+
+    :param payload: the bytes of the page, or a memoryview of them.
+    :param charset: a Python codec, e.g. from sniff_charset.
+    :param truncated: whether the page was cut off, a character cut off at the end is then dropped.
+    """
+    return codecs.getincrementaldecoder(charset)(errors="replace").decode(payload, final=not truncated)
+
+
+def normalize_charset(charset: Optional[str]) -> str:
+    """
+    Gets the Python codec for a declared charset, or the default if it is missing or unknown.
+    """
+    if not charset:
+        return DEFAULT_CHARSET
+    try:
+        name = codecs.lookup(charset).name
+        b"-".decode(name, errors="ignore")  # Rejects codecs that are not text encodings, e.g. base64
+    except LookupError:
+        return DEFAULT_CHARSET
+    return WEB_CHARSETS.get(name, name)
+
+
 def get_text(connection_or_html) -> str:
     """
-    Uses BeautifulSoup to get text from HTML
+    Uses BeautifulSoup to get text from HTML, or the same from htmlstream, see config.PARSER
     """
+    if not isinstance(connection_or_html, BeautifulSoup) and config.PARSER == "stream":
+        return join_text(htmlstream.extract(connection_or_html).strings)
+
     # https://stackoverflow.com/questions/1936466/beautifulsoup-grab-visible-webpage-text/1983219#1983219
     if isinstance(connection_or_html, BeautifulSoup):
         soup = connection_or_html
@@ -80,36 +478,131 @@ def get_text(connection_or_html) -> str:
 
     # txt = soup.get_text(separator="\t\t")
     # split = txt.split("\t\t")
-    split = [re.sub(r"\s+", " ", s) for s in soup.stripped_strings]
+    return join_text(soup.stripped_strings)
+
+
+def join_text(strings) -> str:
+    """
+    Joins the visible strings of a page into its text, one tab separated segment per string.
+    """
+    split = [re.sub(r"\s+", " ", s) for s in strings]
     split = [s for s in split if s]
 
     return "\t".join(split)
 
 
 def get_text_and_links(connection_or_html):
-    soup = BeautifulSoup(connection_or_html, "html.parser")
-    txt = get_text(soup)
-    links = [link.get("href") for link in soup.find_all("a", attrs={"href": True})]
-    return txt, links
+    parsed = parse_html(connection_or_html)
+    return parsed.text, parsed.links
+
+
+def parse_html(html, text: bool = True, links: bool = True, tags: bool = True) -> ParsedHtml:
+    """
+    Parses HTML once, and extracts the visible text, the anchor links, the <html> lang attribute
+    and the scheme of every <a> and <link> tag.
+
+    :param html: the html of the page, or an already parsed BeautifulSoup object (which is modified).
+                 The html is parsed as config.PARSER says, with the same results.
+    :param text: whether to extract the text, None in the result if not.
+    :param links: whether to extract the anchor links, None in the result if not.
+    :param tags: whether to place the <a> and <link> tags, None in the result if not.
+    :return: a ParsedHtml tuple.
+    """
+    if not isinstance(html, BeautifulSoup) and config.PARSER == "stream":
+        with metrics.timed("parse"):
+            extracted = htmlstream.extract(html, tags=tags)
+        hrefs = [href for href, _ in extracted.links] if links else None
+        tag_links = None
+        if tags:
+            with metrics.timed("place_tags"):
+                tag_links = list(zip(place_tags(extracted.tags), (t.get("href") for t in extracted.tags)))
+        txt = None
+        if text:
+            with metrics.timed("get_text"):
+                txt = join_text(extracted.strings)
+        return ParsedHtml(text=txt, links=hrefs, html_lang=extracted.html_lang, tag_links=tag_links)
+
+    with metrics.timed("parse"):
+        soup = html if isinstance(html, BeautifulSoup) else BeautifulSoup(html, "html.parser")
+
+        tag = soup.find("html")
+        html_lang = tag.get("lang") if tag else None
+        hrefs = [link.get("href") for link in soup.find_all("a", attrs={"href": True})] if links else None
+
+    tag_links = None
+    if tags:
+        # Tags must be placed before get_text extracts the invisible parts of the tree
+        with metrics.timed("place_tags"):
+            found = soup.find_all(["a", "link"])
+            tag_links = list(zip(place_tags(found), (t.get("href") for t in found)))
+
+    txt = None
+    if text:
+        with metrics.timed("get_text"):
+            txt = get_text(soup)
+
+    return ParsedHtml(text=txt, links=hrefs, html_lang=html_lang, tag_links=tag_links)
 
 
 def geo(ip: str) -> str:
     """
     Attempts to find geolocation of connection from IP.
+    Results are cached per IP, or per /24 prefix when the GeoIP record covers the whole prefix.
     """
-    response = reader.country(ip)
+    prefix = _geo_prefix(ip)
+    iso_code = _geo_cache.get(prefix if prefix in _geo_cache else ip)
+    if iso_code is not None:  # "" for addresses without a country
+        return iso_code or None
 
-    return response.country.iso_code
+    response = get_reader().country(ip)
+    iso_code = response.country.iso_code
+
+    network = response.traits.network
+    if prefix and network is not None and network.prefixlen <= GEO_PREFIX_LEN:
+        _geo_cache.put(prefix, iso_code or "")
+    else:
+        _geo_cache.put(ip, iso_code or "")
+    return iso_code
 
 
-def detect_language(html: Optional[str] = None, txt: Optional[str] = None,
+def get_reader() -> Reader:
+    """
+    Gets the GeoIP database reader, opening it on first use.
+    """
+    global _reader
+    if _reader is None:
+        _reader = Reader('res/GeoIP2-Country.mmdb')
+    return _reader
+
+
+def warm_up():
+    """
+    Loads the patterns and the GeoIP database, and runs every feature extractor once,
+    so that the first page analyzed is not slowed down by initialization.
+    """
+    patterns.load()
+    get_reader()
+    scan_features("Ola Nordmann, 0150 Oslo, +47 22 22 22 22, 100 kr, post@nb.no")
+    parse_html('<html lang="no"><body><a href="/no/" hreflang="no">Norsk</a></body></html>')
+    detect_language(txt="Dette er en norsk tekst.")
+
+
+def _geo_prefix(ip: str) -> Optional[str]:
+    """
+    Gets the /24 prefix of an IPv4 address, e.g. "192.0.2.1" -> "192.0.2", or None for IPv6.
+    """
+    head, sep, _ = ip.rpartition(".")
+    return head if sep and ":" not in ip else None
+
+
+def detect_language(html: Union[str, bytes, None] = None, txt: Optional[str] = None,
                     domain: Optional[str] = None, http_lang: Optional[str] = None) -> dict:
     """
     Uses cld2 to detect languages, and formats into dict.
     If both html and txt is supplied, it will attempt to pick the best one.
 
     :param domain: domain of web page, used to weight languages.
-    :param html: the html of the page.
+    :param html: the html of the page, or the html encoded as UTF-8 which saves pycld2 encoding it.
     :param txt: the extracted text from the page.
     :param http_lang: HTTP language header
     :return: is_reliable, bytes_found, details
@@ -124,7 +617,8 @@ def detect_language(html: Optional[str] = None, txt: Optional[str] = None,
             irh, bfh, dth = pycld2.detect(html, isPlainText=False, hintTopLevelDomain=domain,
                                           hintLanguageHTTPHeaders=http_lang)
         except pycld2.error:
-            pass
+            if isinstance(html, bytes):  # Invalid UTF-8, e.g. cut off by the size limit
+                return detect_language(html.decode("utf-8", errors="replace"), txt, domain, http_lang)
 
     if txt:
         if irh and bfh > len(txt):  # No point in raw text detection
@@ -187,10 +681,153 @@ def get_ip(connection: HTTPResponse) -> str:
     """
     Finds IP of connection.
     """
-    ip = socket.gethostbyname(urlparse(connection.geturl()).hostname)
+    return resolve(urlparse(connection.geturl()).hostname)
+
+
+def resolve(hostname: str) -> str:
+    """
+    Looks up the IPv4 address of a hostname, cached for DNS_CACHE_TTL seconds.
+    """
+    ip = _ip_cache.get(hostname)
+    if ip is None:
+        ip = socket.gethostbyname(hostname)
+        _ip_cache.put(hostname, ip)
+    return ip
+
+
+async def resolve_async(hostname: str) -> str:
+    """
+    Same as resolve, but without blocking the event loop.
+    """
+    ip = _ip_cache.get(hostname)
+    if ip is None:
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(hostname, None, family=socket.AF_INET)
+        ip = infos[0][4][0]
+        _ip_cache.put(hostname, ip)
     return ip
 
 
+def cache_stats() -> dict:
+    """
+    Gets the size, hits and misses of the lookup caches and the content memos.
+    """
+    return {"ip": _ip_cache.stats(), "geo": _geo_cache.stats(), "parse": _parse_memo.stats(),
+            "language": _language_memo.stats(), "features": _features_memo.stats()}
+
+
+def record_cache_stats():
+    """
+    Sets the cache gauges of the metrics to the stats of the caches of this process, see cache_stats.
+    """
+    for cache, stats in cache_stats().items():
+        metrics.set_gauge(metrics.CACHE_HITS, stats["hits"], cache=cache)
+        metrics.set_gauge(metrics.CACHE_MISSES, stats["misses"], cache=cache)
+        metrics.set_gauge(metrics.CACHE_SIZE, stats["size"], cache=cache)
+
+
+def clear_memos():
+    """
+    Forgets the memoized parses, languages and features, e.g. to measure the work they save.
+    """
+    for memo in (_parse_memo, _language_memo, _features_memo):
+        memo.clear()
+
+
+def parse_html_memo(html: str, text: bool = True, links: bool = True, tags: bool = True) -> ParsedHtml:
+    """
+    Same as parse_html, but reuses the result for identical HTML. The result must not be modified.
+    A full parse of the HTML is reused for a partial one.
+    """
+    digest = content_hash(html)
+    key = digest, text, links, tags
+    full = digest, True, True, True
+    parsed = _parse_memo.get(full if full in _parse_memo else key)
+    if parsed is None:
+        parsed = parse_html(html, text=text, links=links, tags=tags)
+        _parse_memo.put(key, parsed)
+    return parsed
+
+
+def detect_language_memo(html: Union[str, bytes, None] = None, txt: Optional[str] = None,
+                         domain: Optional[str] = None, http_lang: Optional[str] = None) -> dict:
+    """
+    Same as detect_language, but reuses the result for identical content and hints.
+    """
+    key = content_hash(html, txt, domain, http_lang)
+    language = _language_memo.get(key)
+    if language is None:
+        language = detect_language(html, txt, domain, http_lang)
+        _language_memo.put(key, language)
+    return dict(language)  # The caller may add to it, e.g. the norwegian_score
+
+
+def scan_features_memo(txt: str) -> dict:
+    """
+    Same as scan_features, but reuses the result for identical text.
+    """
+    key = content_hash(txt)
+    features = _features_memo.get(key)
+    if features is None:
+        features = scan_features(txt)
+        _features_memo.put(key, features)
+    return {name: Counter(counter) for name, counter in features.items()}
+
+
+def scan_features_guarded_memo(txt: str) -> tuple:
+    """
+    Same as scan_features_guarded, but reuses the result for identical text.
+    """
+    key = content_hash(txt, "guarded")
+    features = _features_memo.get(key)
+    if features is None:
+        features = scan_features_guarded(txt)
+        _features_memo.put(key, features)
+    counters, ratios = features
+    return {name: Counter(counter) for name, counter in counters.items()}, dict(ratios)
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Gets the shared aiohttp session, creating it on first use.
+    Connections are kept alive and pooled per host, and DNS lookups are cached.
+    Must be called from within a running event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        # IPv4 only, to give the same addresses as socket.gethostbyname
+        connector = aiohttp.TCPConnector(limit=POOL_LIMIT, limit_per_host=POOL_LIMIT_PER_HOST,
+                                         ttl_dns_cache=DNS_CACHE_TTL, keepalive_timeout=KEEPALIVE_TIMEOUT,
+                                         family=socket.AF_INET)
+        _session = aiohttp.ClientSession(connector=connector, headers=HEADERS,
+                                         timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT))
+    return _session
+
+
+async def close_session():
+    """
+    Closes the shared aiohttp session, if open.
+    """
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def get_ip_async(response: aiohttp.ClientResponse) -> str:
+    """
+    Finds IP of an aiohttp response.
+    Uses the peer address of the open connection, and only falls back to a lookup if it has been released.
+    """
+    connection = response.connection
+    transport = connection.transport if connection else None
+    peer = transport.get_extra_info("peername") if transport else None
+    if peer:
+        _ip_cache.put(response.url.host, peer[0])
+        return peer[0]
+    return await resolve_async(response.url.host)
+
+
 def get_domain(url: str) -> str:
     """
     Gets domain from URL. E.g. "https://stackoverflow.com/" -> "com"
@@ -220,42 +857,70 @@ def place_tag(t: Tag) -> str:
     """
     Analyzes a HTML tag and returns the associated scheme.
     """
-    if not t.get("href"):
-        return NO_MATCH
+    return place_tags([t])[0]
 
-    # Schemes are ordered from presumed strongest to weakest
 
-    # Method recommended by Google to specify alternate versions of page
-    # https://support.google.com/webmasters/answer/189077?hl=en
-    rel = t.get("rel", "")
-    hreflang = t.get("hreflang", "")
-    pat = re.compile("alternat(e|ive)")
-    if t.name == "link" and pattern_no_html_lang.search(hreflang) and any(pat.search(r) for r in rel):
-        return HREF_HREFLANG_REL
-
-    # Full matches Norway regex in text with repetitions
-    pat = re.compile(f"^(\\W*({expressions['norway_names']}|no|bokmål|nynorsk))+\\W*$", re.I)
-    title = t.get("title", "")
-    if t.name == "a" and (pat.search(t.get_text(separator=" ")) or pat.search(t.get("title", ""))):
-        return HREF_NORWAY_FULL
-
-    # Other hreflang links
-    if pattern_no_html_lang.search(hreflang):
-        return HREF_HREFLANG
-
-    # Matches Norwegian lang tag
-    lang = t.get("lang", "")
-    if pattern_no_html_lang.search(lang):
-        return HREF_LANG
+def place_tags(tags: list) -> list:
+    """
+    Analyzes HTML tags and returns the associated scheme of each.
+    The partial Norway patterns are run once over the texts, titles and links of all the tags
+    left undecided by the stronger schemes, instead of once per tag.
+    """
+    schemes = [NO_MATCH] * len(tags)
+    texts, titles, hrefs = {}, {}, {}  # Of undecided <a> tags
+
+    # Schemes are ordered from presumed strongest to weakest
+    for i, t in enumerate(tags):
+        href = t.get("href")
+        if not href:
+            continue
+
+        # Method recommended by Google to specify alternate versions of page
+        # https://support.google.com/webmasters/answer/189077?hl=en
+        rel = t.get("rel", "")
+        hreflang = t.get("hreflang", "")
+        if t.name == "link" and patterns.pattern_no_html_lang.search(hreflang) \
+                and any(patterns.pattern_alternate.search(r) for r in rel):
+            schemes[i] = HREF_HREFLANG_REL
+            continue
+
+        # Full matches Norway regex in text with repetitions
+        if t.name == "a":
+            text = t.get_text(separator=" ")
+            title = t.get("title", "")
+            if patterns.pattern_norway_full.search(text) or patterns.pattern_norway_full.search(title):
+                schemes[i] = HREF_NORWAY_FULL
+                continue
+
+        # Other hreflang links
+        if patterns.pattern_no_html_lang.search(hreflang):
+            schemes[i] = HREF_HREFLANG
+
+        # Matches Norwegian lang tag
+        elif patterns.pattern_no_html_lang.search(t.get("lang", "")):
+            schemes[i] = HREF_LANG
+
+        elif t.name == "a":
+            texts[i], titles[i], hrefs[i] = text, title, href
 
     # Matches Norway regex in text
-    if t.name == "a" and (pattern_norway.search(t.get_text(separator=" ")) or pattern_norway.search(title)):
-        return HREF_NORWAY_PARTIAL
+    partial = _search_all(patterns.pattern_norway, texts) | _search_all(patterns.pattern_norway, titles)
+    for i in partial:
+        schemes[i] = HREF_NORWAY_PARTIAL
 
     # Matches Norway regex in link
-    pat = re.compile(f"{expressions['norway_names']}|bokmål|nynorsk")
-    hr = t.get("href", "")
-    if t.name == "a" and pat.search(hr):
-        return HREF_NORWAY_LINK
+    for i in _search_all(patterns.pattern_norway_link, {i: h for i, h in hrefs.items() if i not in partial}):
+        schemes[i] = HREF_NORWAY_LINK
 
-    return NO_MATCH
+    return schemes
+
+
+def _search_all(pattern: re.Pattern, strings: dict) -> set:
+    """
+    Finds the keys of the strings that the pattern can be found in, by scanning them all at once.
+    The pattern must not be able to match across the NUL separator.
+    """
+    keys = list(strings)
+    joined = "\0".join(strings.values())
+    starts = list(accumulate((len(s) + 1 for s in strings.values()), initial=0))
+    return {keys[bisect_right(starts, m.start()) - 1] for m in pattern.finditer(joined)}
@@ -0,0 +1,148 @@
+"""
+Line diffs of page texts, fast enough to run on every harvest of a page.
+Without the "?" hints, lines are compared by hash, and aligned with Myers' linear space diff,
+which is O((N + M) D) for D changed lines, instead of difflib's quadratic matching.
+That aligns the lines by a longest common subsequence, which when lines repeat may differ from the one difflib finds,
+so the sets are then not always the same as difflib.Differ's. With the hints, they are.
+"""
+import difflib
+from typing import List, Tuple
+
+SAME, ADDED, REMOVED, HINT = " +-?"
+
+# Edits searched from each end before settling for a split that is not optimal, as GNU diff does.
+# Keeps pages that were rewritten or reordered from taking quadratic time, while small changes are diffed exactly.
+MAX_COST = 256
+
+
+def matching_lines(a: list, b: list) -> List[Tuple[int, int]]:
+    """
+    Finds a longest common subsequence of two lists of lines.
+    :return: the indices (i, j) of the matching lines, a[i] == b[j], in increasing order.
+    """
+    # Lines are replaced by small ints, and lines only found on one side are left out as they never match
+    ids = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_only = len(ids)
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    in_b = set(b_ids)
+    a_keep = [i for i, x in enumerate(a_ids) if x in in_b]
+    b_keep = [j for j, x in enumerate(b_ids) if x < b_only]
+
+    matches = []
+    _diff([a_ids[i] for i in a_keep], [b_ids[j] for j in b_keep], 0, len(a_keep), 0, len(b_keep), matches)
+    return [(a_keep[i], b_keep[j]) for i, j in matches]
+
+
+def _diff(a: list, b: list, a0: int, a1: int, b0: int, b1: int, matches: list):
+    """
+    Adds the matches of a[a0:a1] and b[b0:b1] to matches, in order.
+    """
+    while a0 < a1 and b0 < b1 and a[a0] == b[b0]:
+        matches.append((a0, b0))
+        a0 += 1
+        b0 += 1
+    suffix = 0
+    while a0 < a1 and b0 < b1 and a[a1 - 1] == b[b1 - 1]:
+        a1 -= 1
+        b1 -= 1
+        suffix += 1
+
+    # With the common ends trimmed, a middle where both sides are left takes at least two edits,
+    # so the middle snake splits it into two smaller parts
+    if a0 < a1 and b0 < b1:
+        x, y, u, v = _middle_snake(a, b, a0, a1, b0, b1)
+        _diff(a, b, a0, x, b0, y, matches)
+        matches.extend(zip(range(x, u), range(y, v)))
+        _diff(a, b, u, a1, v, b1, matches)
+
+    matches.extend(zip(range(a1, a1 + suffix), range(b1, b1 + suffix)))
+
+
+def _middle_snake(a: list, b: list, a0: int, a1: int, b0: int, b1: int) -> Tuple[int, int, int, int]:
+    """
+    Finds the middle snake of an optimal edit path, by searching from both ends until the paths overlap.
+    See Myers, "An O(ND) Difference Algorithm and Its Variations", 1986.
+    If there are more than 2 * MAX_COST edits, it splits at the furthest point the forward search reached instead.
+    :return: the start (x, y) and end (u, v) of the snake, in a and b.
+    """
+    n, m = a1 - a0, b1 - b0
+    delta = n - m
+    odd = delta & 1
+    offset = (n + m + 1) // 2 + 1
+    forward = [0] * (2 * offset + 1)  # Furthest x on each diagonal k = x - y, at offset + k
+    backward = [0] * (2 * offset + 1)  # The same from the ends, where diagonal k is delta - k from the start
+
+    for d in range(offset):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            start = x, y
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if odd and -(d - 1) <= delta - k <= d - 1 and x + backward[offset + delta - k] >= n:
+                return a0 + start[0], b0 + start[1], a0 + x, b0 + y
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            start = x, y
+            while x < n and y < m and a[a1 - 1 - x] == b[b1 - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d and x + forward[offset + delta - k] >= n:
+                return a0 + n - x, b0 + m - y, a0 + n - start[0], b0 + m - start[1]
+
+        if d >= MAX_COST:
+            # Furthest x + y, on the diagonals that have not run past the ends
+            _, x, k = max((2 * forward[offset + k] - k, forward[offset + k], k) for k in range(-d, d + 1, 2)
+                          if forward[offset + k] <= n and 0 <= forward[offset + k] - k <= m)
+            return a0 + x, b0 + x - k, a0 + x, b0 + x - k
+
+    raise AssertionError("The searches from both ends did not meet")
+
+
+def diff_lines(a: list, b: list, hints: bool = True) -> Tuple[set, set, set, set]:
+    """
+    Compares two lists of lines, like difflib.Differ.
+    :param hints: find the lines of replaced blocks that changed only slightly, and the hints of what changed,
+                  which gives the same sets as difflib.Differ, but takes as long, quadratic in the replaced blocks.
+                  If False, the lines are aligned by matching_lines and replaced blocks are all removed and added,
+                  which is much faster, but may give other sets than Differ when lines repeat.
+    :return: the sets of lines that are the same, added, removed, and the "?" hints.
+    """
+    sets = set(), set(), set(), set()  # same, added, removed, neither
+    same, added, removed, _ = sets
+    if hints:
+        # Differ.compare, without formatting the lines that are the same, added or removed
+        differ = difflib.Differ()
+        for tag, i, mi, j, mj in difflib.SequenceMatcher(None, a, b).get_opcodes():
+            if tag == "replace":
+                for comp in differ._fancy_replace(a, i, mi, b, j, mj):
+                    for c, s in zip(SAME + ADDED + REMOVED + HINT, sets):
+                        if comp[0] == c:
+                            s.add(comp[2:])
+            elif tag == "equal":
+                same.update(a[i:mi])
+            else:
+                removed.update(a[i:mi])
+                added.update(b[j:mj])
+        return sets
+
+    i = j = 0
+    for mi, mj in matching_lines(a, b) + [(len(a), len(b))]:
+        removed.update(a[i:mi])
+        added.update(b[j:mj])
+        if mi < len(a):
+            same.add(a[mi])
+        i, j = mi + 1, mj + 1
+    return sets
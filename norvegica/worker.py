@@ -0,0 +1,168 @@
+"""
+Runs the CPU-bound page analysis away from the event loop, so the server can use all the cores of its pod.
+"""
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, Optional, Union
+
+import config
+import metrics
+import souper
+from probe import Prober
+from profiling import profile_call
+from WebPage import WebPage
+
+PROCESS = "process"
+THREAD = "thread"
+INLINE = "inline"
+EXECUTORS = PROCESS, THREAD, INLINE
+
+_executor: Optional[Executor] = None
+
+
+def init_worker():
+    """
+    Loads the patterns, expressions.json and the GeoIP reader once, instead of on the first page of each worker.
+    """
+    souper.warm_up()
+
+
+def init_process():
+    """
+    Same as init_worker, but does not report the warm-up in the metrics of the server.
+    """
+    init_worker()
+    metrics.registry.drain()
+
+
+def analyze(fields: dict, profile: bool = False, select: Optional[Iterable[str]] = None) -> dict:
+    """
+    Creates a WebPage and computes its extra_info.
+    :param fields: the WebPage constructor arguments, see WebPage.fields.
+    :param profile: run the analysis under cProfile, and add the hot functions to the result as "profile".
+    :param select: only compute these fields of extra_info, see WebPage.info.
+    """
+    return _analyze(fields, profile, False, select)[0]
+
+
+def classify(fields: dict, thresholds: Optional[Iterable[float]] = None) -> dict:
+    """
+    Creates a WebPage and decides whether its norvegica_score reaches each threshold, see WebPage.cascade.
+    :param fields: the WebPage constructor arguments, see WebPage.fields.
+    """
+    return WebPage(**fields).cascade(thresholds)
+
+
+def language(fields: Optional[dict], html: Union[str, bytes, None] = None, txt: Optional[str] = None,
+             domain: Optional[str] = None, http_lang: Optional[str] = None) -> dict:
+    """
+    Detects the language of a page, as the /language service does, see souper.detect_language.
+    :param fields: the WebPage constructor arguments of a fetched page, whose HTML, text, domain and Content-Language
+                   are used. If None, the other arguments are used as given.
+    """
+    if fields is not None:
+        wp = WebPage(**fields)
+        txt = wp.parse(links=False, tags=False).text  # The links are not needed
+        html, domain, http_lang = wp.html_bytes, souper.get_domain(wp.redirect_url), wp.content_language
+    return souper.detect_language_memo(html=html, txt=txt, domain=domain, http_lang=http_lang)
+
+
+def _analyze(fields: dict, profile: bool, with_candidates: bool, select: Optional[Iterable[str]] = None) -> tuple:
+    """
+    Runs analyze, and also gives the arguments of Prober.norwegian_version if the candidates are to be probed.
+    """
+    wp = WebPage(**fields)
+    if profile:
+        result, stats = profile_call(lambda: wp.info(select), top=config.PROFILE_TOP, dump_dir=config.PROFILE_DIR,
+                                     name=wp.original_url or "")
+        result = dict(result, profile=stats)
+    else:
+        result = wp.info(select)
+    if not with_candidates:
+        return result, None
+    return result, (wp.norwegian_candidates(), wp.original_url, wp.redirect_url, wp.ip)
+
+
+def get_executor() -> Optional[Executor]:
+    """
+    Returns the executor configured by NORVEGICA_EXECUTOR, creating it on first use. None when running inline.
+    """
+    global _executor
+    if _executor is None and config.EXECUTOR != INLINE:
+        if config.EXECUTOR == PROCESS:
+            # Forking a process that runs an event loop is unsafe, start workers from a clean server process instead
+            _executor = ProcessPoolExecutor(max_workers=config.WORKERS, initializer=init_process,
+                                            mp_context=multiprocessing.get_context("forkserver"))
+        elif config.EXECUTOR == THREAD:
+            _executor = ThreadPoolExecutor(max_workers=config.WORKERS, initializer=init_worker)
+        else:
+            raise ValueError(f"Unknown executor {config.EXECUTOR!r}, expected one of {EXECUTORS}")
+    return _executor
+
+
+async def analyze_async(fields: dict, profile: bool = False, prober: Optional[Prober] = None,
+                        select: Optional[Iterable[str]] = None) -> dict:
+    """
+    Same as analyze, but awaits the result from the configured executor.
+    :param prober: verifies the Norwegian version of the page, which is otherwise not checked.
+    :param select: only compute these fields of extra_info, see WebPage.info.
+    """
+    if select is not None:
+        select = list(select)
+    probe = prober is not None and (select is None or "norwegian_version" in select)
+    result, candidates = await run_async(_analyze, fields, profile, probe, select)
+    if probe:
+        with metrics.timed("probe"):
+            result["norwegian_version"] = await prober.norwegian_version(*candidates)
+    return result
+
+
+async def language_async(fields: Optional[dict], html: Union[str, bytes, None] = None, txt: Optional[str] = None,
+                         domain: Optional[str] = None, http_lang: Optional[str] = None) -> dict:
+    """
+    Same as language, but awaits the result from the configured executor.
+    """
+    return await run_async(language, fields, html, txt, domain, http_lang)
+
+
+async def run_async(func: Callable, *args):
+    """
+    Awaits func(*args) from the configured executor, or runs it inline.
+    """
+    executor = get_executor()
+    if executor is None:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    if isinstance(executor, ProcessPoolExecutor):
+        result, values = await loop.run_in_executor(executor, _run_in_process, func, *args)
+        metrics.registry.merge(values)
+        return result
+    return await loop.run_in_executor(executor, func, *args)
+
+
+def _run_in_process(func: Callable, *args) -> tuple:
+    """
+    Runs a function in a worker process, and sends back the metrics it recorded along with the result,
+    and the stats of its caches.
+    """
+    result = func(*args)
+    souper.record_cache_stats()
+    return result, metrics.registry.drain()
+
+
+async def start():
+    """
+    Starts the workers, and waits until they are ready.
+    """
+    executor = get_executor()
+    if executor is not None:
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(executor, int) for _ in range(config.WORKERS)))
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
@@ -24,9 +24,11 @@ def get_names(file, delimiter=";"):
 source = open("res/Postnummerregister-ansi.txt", encoding="iso 8859-1")
 rdr = csv.reader(source, delimiter="\t")
 postal = []
+postal_codes = {}  # Code -> city, for hash lookups instead of the alternation
 
 for row in rdr:
     postal.append(row[0] + ",? " + row[1])
+    postal_codes[row[0]] = row[1]
 
 postal = "|".join(postal)
 
@@ -83,6 +85,7 @@ cctld = "ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg
 
 d = {
     "postal": postal,
+    "postal_codes": postal_codes,
     "boy_names": boy_names,
     "girl_names": girl_names,
     "surnames": surnames,
@@ -18,26 +18,29 @@ def record_to_webpage(record):
             and record.content_type == 'application/http; msgtype=response' \
             and record.http_headers.get_statuscode() == "200" \
             and re.fullmatch(r"https?:\/\/[\w.]+no(:\d+)?\/?", uri):
-        html = str(record.raw_stream.read(), "utf-8", errors="replace")
+        payload = record.raw_stream.read()  # Decoded by the WebPage when needed
+        charset = souper.sniff_charset(payload[:souper.SNIFF_BYTES], record.http_headers.get_header('Content-Type'))
         ip = record.rec_headers.get_header('WARC-IP-Address')
         content_language = record.http_headers.get_header('Content-Language')
         last_modified = record.http_headers.get_header("Last-Modified")
         etag = record.http_headers.get_header("ETag")
         timestamp = parser.parse(record.rec_headers.get_header("WARC-Date")).timestamp()
-        webpage = WebPage(orig_url=uri, redirect_url=uri, raw_html=html, ip=ip, timestamp=int(timestamp), geo_loc=None,
-                          content_language=content_language, last_modified=last_modified, etag=etag)
+        webpage = WebPage(orig_url=uri, redirect_url=uri, raw_html=payload, ip=ip, timestamp=int(timestamp),
+                          geo_loc=None, content_language=content_language, last_modified=last_modified, etag=etag,
+                          charset=charset)
         return webpage
     return None
 
 
 def get_info(record):
     uri = record.rec_headers.get_header('WARC-Target-URI')
-    html = str(record.raw_stream.read(), "utf-8", errors="replace")
+    payload = record.raw_stream.read()  # Decoded in the worker process, see process
+    charset = souper.sniff_charset(payload[:souper.SNIFF_BYTES], record.http_headers.get_header('Content-Type'))
     content_language = record.http_headers.get_header('Content-Language')
     last_modified = record.http_headers.get_header("Last-Modified")
     etag = record.http_headers.get_header("ETag")
     timestamp = parser.parse(record.rec_headers.get_header("WARC-Date")).timestamp()
-    return [uri, timestamp, content_language, last_modified, etag, html]
+    return [uri, timestamp, content_language, last_modified, etag, charset, payload]
 
 
 if __name__ == '__main__':
@@ -54,8 +57,8 @@ if __name__ == '__main__':
 
 
     def process(wp):
-        html = wp[-1]
-        txt, links = souper.get_text_and_links(html)
+        charset, payload = wp.pop(-2), wp[-1]
+        txt, links = souper.get_text_and_links(souper.decode_page(payload, charset))
         wp[-1] = txt
         wp.append("\t".join(links))
         return wp
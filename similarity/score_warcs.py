@@ -0,0 +1,194 @@
+"""
+Scores the pages in WARC files with norvegica, and writes the results as they are done.
+Each WARC file gets its own directory of output parts, and a _DONE marker once it is complete,
+so an interrupted run continues with the files that were not finished.
+
+Run from the repository root with norvegica on the path, e.g.
+`PYTHONPATH=norvegica python similarity/score_warcs.py scores/ crawl/*.warc.gz`
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import pandas as pd
+from warcio.archiveiterator import WARCIterator
+
+import rescore
+import worker
+from iterate_warcs import record_to_webpage
+from WebPage import WebPage
+
+JSONL = "jsonl"
+PARQUET = "parquet"
+DONE = "_DONE"
+
+
+class PartWriter:
+    """
+    Writes rows to numbered part files in a directory, starting a new part every part_size rows.
+    """
+
+    def __init__(self, directory: str, fmt: str = JSONL, part_size: int = 10000, features: bool = False):
+        """
+        :param features: also write the raw features of the rows to features-<part>.npz, see rescore.py.
+        """
+        self.directory = directory
+        self.fmt = fmt
+        self.part_size = part_size
+        self.features = features
+        self.parts = 0
+        self._rows = []  # Rows of the current Parquet part, which is written at once
+        self._vectors = []
+        self._file = None
+        self._count = 0
+
+    def write(self, row: dict):
+        if self._count == 0:
+            self.parts += 1
+        if self.fmt == JSONL:
+            if self._file is None:
+                self._file = open(self._path("part", self.fmt), "w", encoding="utf-8")
+            self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        else:
+            self._rows.append(row)
+        if self.features:
+            self._vectors.append((row["original_url"], rescore.feature_vector(row)))
+        self._count += 1
+        if self._count >= self.part_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Finishes the current part.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._rows:
+            pd.json_normalize(self._rows).to_parquet(self._path("part", self.fmt), index=False)
+            self._rows = []
+        if self._vectors:
+            urls, vectors = zip(*self._vectors)
+            rescore.save(self._path("features", "npz"), rescore.to_columns(vectors, urls))
+            self._vectors = []
+        self._count = 0
+
+    def _path(self, name: str, ext: str) -> str:
+        return os.path.join(self.directory, f"{name}-{self.parts - 1:05d}.{ext}")
+
+
+def score_file(path: str, out_dir: str, executor: ProcessPoolExecutor, in_flight: int, fmt: str = JSONL,
+               part_size: int = 10000, select: Optional[list] = None, features: bool = False,
+               thresholds: Optional[list] = None) -> dict:
+    """
+    Scores the pages of one WARC file, see record_to_webpage, and writes the results to out_dir.
+    At most in_flight pages are read ahead of the results being written, which bounds the memory used.
+
+    :param thresholds: only decide whether the score of each page reaches these, see WebPage.cascade.
+    :return: counts of the records read, the pages scored and the pages that failed.
+    """
+    stats = {"records": 0, "pages": 0, "errors": 0}
+    writer = PartWriter(out_dir, fmt, part_size, features)
+    pending = deque()
+
+    def write_next():
+        url, future = pending.popleft()
+        try:
+            writer.write(future.result())
+            stats["pages"] += 1
+        except Exception as e:
+            print(f"{path}: {url}: {type(e).__name__}: {e}", file=sys.stderr)
+            stats["errors"] += 1
+
+    start = time.perf_counter()
+    with open(path, "rb") as stream:
+        for record in WARCIterator(stream):
+            stats["records"] += 1
+            try:
+                wp = record_to_webpage(record)
+            except Exception as e:
+                print(f"{path}: record {stats['records']}: {type(e).__name__}: {e}", file=sys.stderr)
+                stats["errors"] += 1
+                continue
+            if wp is None:
+                continue
+            if len(pending) >= in_flight:
+                write_next()
+            if thresholds:
+                future = executor.submit(worker.classify, wp.fields, thresholds)
+            else:
+                future = executor.submit(worker.analyze, wp.fields, select=select)
+            pending.append((wp.original_url, future))
+
+    while pending:
+        write_next()
+    writer.flush()
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+    return stats
+
+
+def output_dir(out: str, path: str) -> str:
+    name = os.path.basename(path)
+    for ext in (".gz", ".warc"):
+        name = name[:-len(ext)] if name.endswith(ext) else name
+    return os.path.join(out, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out", help="directory to write the results to, one subdirectory per WARC file")
+    parser.add_argument("warcs", nargs="+", help="WARC files to score")
+    parser.add_argument("--format", choices=(JSONL, PARQUET), default=JSONL,
+                        help="JSON lines, or Parquet with the nested fields flattened (requires pyarrow)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--in-flight", type=int, default=None,
+                        help="pages read ahead of the results, 4 per worker by default")
+    parser.add_argument("--part-size", type=int, default=10000, help="rows per output part")
+    parser.add_argument("--fields", default=None, help="comma separated fields of the results, all by default")
+    parser.add_argument("--features", action="store_true",
+                        help="also store the raw features of each part, to rescore them with rescore.py")
+    parser.add_argument("--cascade", default=None,
+                        help="comma separated scores to only decide whether the pages reach, which skips the features "
+                             "that cannot change the decision")
+    args = parser.parse_args()
+
+    if args.format == PARQUET:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error("Parquet output requires pyarrow")
+    select = [field.strip() for field in args.fields.split(",")] if args.fields else None
+    if select is not None and set(select).difference(WebPage.FIELDS):
+        parser.error(f"Unknown fields, expected some of {', '.join(WebPage.FIELDS)}")
+    if select is not None and args.features:
+        select += [field for field in ("original_url",) + rescore.FIELDS if field not in select]
+    thresholds = [float(t) for t in args.cascade.split(",")] if args.cascade else None
+    if thresholds and (select is not None or args.features):
+        parser.error("--cascade gives its own fields, and cannot be combined with --fields or --features")
+    in_flight = args.in_flight or 4 * args.workers
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=worker.init_worker) as executor:
+        for i, path in enumerate(args.warcs):
+            out_dir = output_dir(args.out, path)
+            if os.path.exists(os.path.join(out_dir, DONE)):
+                print(f"{i + 1}/{len(args.warcs)} {path}: already done")
+                continue
+            shutil.rmtree(out_dir, ignore_errors=True)  # Parts from an interrupted run
+            os.makedirs(out_dir)
+
+            stats = score_file(path, out_dir, executor, in_flight, args.format, args.part_size, select,
+                               args.features, thresholds)
+            with open(os.path.join(out_dir, DONE), "w") as f:
+                json.dump(stats, f)
+            print(f"{i + 1}/{len(args.warcs)} {path}: {stats['pages']} pages from {stats['records']} records, "
+                  f"{stats['errors']} errors, {stats['seconds']} s", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,6 @@ from collections import Counter, namedtuple
 from concurrent.futures.process import ProcessPoolExecutor
 
 import numpy as np
-from bs4 import BeautifulSoup
 from scipy.optimize import curve_fit, newton
 from sklearn.metrics import r2_score, mean_squared_error
 
@@ -228,25 +227,28 @@ class HtmlResult(namedtuple("HtmlResult", ["word", "tag", "link", "img"])):
 
 
 def html_to_counters(html):
-    soup = BeautifulSoup(html, "html.parser")
-    [s.extract() for s in soup(['style', 'script', '[document]', 'head', 'title'])]
-    [s.extract() for s in soup.find_all(attrs={"style": re.compile("display: ?none|visibility: ?hidden")})]
+    """
+    Counts the visible text segments, words, links and images of a page, in one pass over the html.
+    Needs norvegica on the path, as harvest_adjust.py does.
+    """
+    import htmlstream
+    extracted = htmlstream.extract(html)
 
     res = HtmlResult(Counter(), Counter(), Counter(), Counter())
 
-    for tag in soup.stripped_strings:
+    for tag in extracted.strings:
         tag = re.sub("\\s+", " ", tag)
         res.tag[tag] += 1
         for word in re.split("\\W+", tag):
             if word:
                 res.word[word] += 1
 
-    for a in soup.find_all("a", attrs={"href": True}):
-        href = a.get("href")
-        res.link[href] += 1
+    for href, visible in extracted.links:
+        if visible:
+            res.link[href] += 1
 
-    for img in soup.find_all("img", attrs={"src": True}):
-        src = img.get("src")
-        res.img[src] += 1
+    for src, visible in extracted.images:
+        if visible:
+            res.img[src] += 1
 
     return res